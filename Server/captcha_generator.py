@@ -1,7 +1,7 @@
+from dataset_store import load_dataset
 import numpy as np
 import random
 import cv2
-import os
 
 
 dataset_path = 'Test'
@@ -9,20 +9,18 @@ dataset_path = 'Test'
 
 def generate_captchas(captchas_amount):
     generated_captcha_paths = []
-    class_names = os.listdir(dataset_path)
+    # the tiles come out of the packed store (already resized to 100x100), only the ones that are picked are read
+    images, labels, class_names = load_dataset(dataset_path)
+    class_indices = [np.flatnonzero(labels == class_index) for class_index in range(len(class_names))]
+    class_indices = [indices for indices in class_indices if len(indices)]
     for i in range(captchas_amount):
         generated_captcha_path = f'payloads/generated/{random.randint(0, 10 ** 6)}.png'
         generated_captcha = np.empty((300, 300, 3))
         for j in range(9):
             row, col = j // 3, j % 3
-            random_class_name = random.choice(class_names)
-            class_path = os.path.join(dataset_path, random_class_name)
-            image_names = os.listdir(class_path)
-            random_image_name = random.choice(image_names)
-            image_path = os.path.join(class_path, random_image_name)
-            image = cv2.imread(image_path)
-            resized_image = cv2.resize(image, (100, 100))
-            generated_captcha[row * 100: (row + 1) * 100, col * 100: (col + 1) * 100] = resized_image[0: 100, 0: 100]
+            random_class_indices = random.choice(class_indices)
+            image = images[random.choice(random_class_indices)]
+            generated_captcha[row * 100: (row + 1) * 100, col * 100: (col + 1) * 100] = image
 
         cv2.imwrite(generated_captcha_path, generated_captcha)
         generated_captcha_paths.append(generated_captcha_path)
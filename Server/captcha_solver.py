@@ -1,13 +1,32 @@
-from keras.models import load_model
 import numpy as np
+import sys
 import cv2
 import os
 
 
-model = load_model('models/top_model.h5')
+# 'keras' runs models/top_model.h5 with TensorFlow, 'numpy' runs the same model converted to the from-scratch library
+# (python "without libraries/keras_import.py" models/top_model.h5 models/top_model.npnet), which skips TensorFlow's startup
+BACKEND = os.environ.get('CAPTCHA_SOLVER_BACKEND', 'keras')
+
+if BACKEND == 'numpy':
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'without libraries'))
+    from serialization import load
+    from network import predict_batch
+    network = load('models/top_model.npnet')
+else:
+    from keras.models import load_model
+    model = load_model('models/top_model.h5')
 class_names = os.listdir('Dataset')
 
 
+# Returns the class probabilities of a batch of (100, 100, 3) tiles
+def predict_tiles(tiles):
+    if BACKEND == 'numpy':
+        # the from-scratch library works in NCHW, its outputs are (n, 1) column vectors
+        return predict_batch(network, tiles.transpose(0, 3, 1, 2))[..., 0]
+    return model.predict(tiles)
+
+
 def solve_captcha(captcha_path, requested_object):
     payload = cv2.imread(captcha_path)
     mini_payloads = []
@@ -17,7 +36,7 @@ def solve_captcha(captcha_path, requested_object):
             mini_payloads.append(mini_payload)
 
     mini_payloads = np.array(mini_payloads) / 255
-    output = model.predict(mini_payloads)
+    output = predict_tiles(mini_payloads)
     # name of the object in each tile
     objects = [class_names[i] for i in np.argmax(output, axis=1)]
     # array of booleans representing presence of requested object in every tile
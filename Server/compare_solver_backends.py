@@ -0,0 +1,73 @@
+from dataset_store import load_dataset
+import numpy as np
+import subprocess
+import random
+import time
+import sys
+import os
+
+
+# Checks that the numpy backend of captcha_solver (models/top_model.npnet, converted from models/top_model.h5 with
+# "without libraries/keras_import.py") gives the same predictions as the Keras model, and compares both backends'
+# startup time and per-solve latency
+# Exits with 1 if the predictions of the two backends disagree
+
+dataset_path = 'Test'
+TOLERANCE = 1e-4  # the converted network runs in float32, like Keras
+SAMPLES = 90
+LATENCY_RUNS = 20
+
+
+def load_test_tiles(samples_amount):
+    images, _, _ = load_dataset(dataset_path)
+    random.seed(0)
+    indices = random.sample(range(len(images)), min(samples_amount, len(images)))
+    return images[indices] / 255
+
+
+def import_solver(backend):
+    os.environ['CAPTCHA_SOLVER_BACKEND'] = backend
+    sys.modules.pop('captcha_solver', None)
+    import captcha_solver
+    return captcha_solver
+
+
+# Importing the solver loads its model, so the import time of a fresh interpreter is the server's startup time
+def measure_startup(backend):
+    environment = dict(os.environ, CAPTCHA_SOLVER_BACKEND=backend)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import captcha_solver'], env=environment, check=True)
+    return time.perf_counter() - start
+
+
+def measure_latency(solver, tiles):
+    solver.predict_tiles(tiles)  # warm up
+    start = time.perf_counter()
+    for _ in range(LATENCY_RUNS):
+        solver.predict_tiles(tiles)
+    return (time.perf_counter() - start) / LATENCY_RUNS
+
+
+def main():
+    tiles = load_test_tiles(SAMPLES)
+    outputs = {}
+    latencies = {}
+    for backend in ('keras', 'numpy'):
+        solver = import_solver(backend)
+        outputs[backend] = np.concatenate([solver.predict_tiles(tiles[i: i + 9]) for i in range(0, len(tiles), 9)])
+        latencies[backend] = measure_latency(solver, tiles[: 9])
+
+    max_difference = np.max(np.abs(outputs['keras'] - outputs['numpy']))
+    agreement = np.mean(np.argmax(outputs['keras'], axis=1) == np.argmax(outputs['numpy'], axis=1))
+    print(f'Parity on {len(tiles)} test tiles: max abs difference {max_difference:.3g}, argmax agreement {agreement:.2%}')
+
+    for backend in ('keras', 'numpy'):
+        print(f'{backend:>5}: startup {measure_startup(backend):.2f} s, solve (9 tiles) {latencies[backend] * 1000:.1f} ms')
+
+    if max_difference > TOLERANCE or agreement < 1:
+        print('The backends disagree')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,54 +2,65 @@ import tensorflow as tf
 from tensorflow.keras.models import Sequential, load_model
 from tensorflow.keras.layers import Conv2D, MaxPooling2D, Flatten, Dense, Dropout
 from matplotlib import pyplot as plt
+from dataset_store import load_dataset, IMAGE_SIZE, CHANNELS
 import numpy as np
-import random
-import pickle
-import cv2
 import os
 
 
 DATASET_PATH = 'Dataset'
-IMAGE_SIZE = 100
-CHANNELS = 3  # for colored images
-
-
-def pickle_the_dataset(dataset_path, pickle_path):
-    data = []
-    classes = os.listdir(dataset_path)
-
-    for class_index, class_name in enumerate(classes):
-        class_path = os.path.join(dataset_path, class_name)  # path to the current class' directory
-        for img_name in os.listdir(class_path):
-            try:
-                # path to current image
-                img_path = os.path.join(class_path, img_name)
-                # the np array representation of the image
-                img_content = cv2.imread(img_path)
-                # Reshape to 100x100
-                img_content = cv2.resize(img_content, (IMAGE_SIZE, IMAGE_SIZE))
-                data.append((img_content, class_index))
-            except Exception as e:
-                print(e)
-
-    # save the data to a binary file
-    pickle_out = open(pickle_path, 'wb')
-    pickle.dump(data, pickle_out)
-    pickle_out.close()
-
-
-def unpickle_data(pickle_path):
-    # load the data from the binary file
-    pickle_in = open(pickle_path, 'rb')
-    data = pickle.load(pickle_in)
-    pickle_in.close()
-    return data
-
-
-def shuffle_data(data, times=5):
-    for i in range(times):
-        random.shuffle(data)
-    return data
+READ_CHUNK = 256  # images read from the store at a time
+SHUFFLE_BUFFER = 1024  # images
+CROP_FRACTION = 0.9  # the side of the random crops of the augmentation, as a fraction of the image's side
+
+
+def shuffle_data(images_amount):
+    # a shuffled order of the images' indices, the images themselves stay in the store
+    return np.random.permutation(images_amount)
+
+
+# A tf.data pipeline of the (x, y) batches of the images at indices, out of the memory mapped store:
+#   the uint8 images are read in chunks (in parallel) and cached in memory as uint8 after the first epoch, shuffled
+#   through a buffer, normalized to float32 (and augmented) in parallel one image at a time, batched and prefetched,
+#   so the next batches are prepared while the model trains on this one
+# The model's input stays [0, 1] floats, which captcha_solver and the converted numpy model expect
+def make_dataset(images, labels, indices, batch_size=32, training=True, augment=False):
+    def read_chunk(chunk_indices):
+        # sorted indices read the memory map front to back
+        chunk_indices = np.sort(chunk_indices)
+        return images[chunk_indices], labels[chunk_indices].astype(np.int32)
+
+    def read(chunk_indices):
+        x, y = tf.numpy_function(read_chunk, [chunk_indices], [tf.uint8, tf.int32])
+        x.set_shape((None, IMAGE_SIZE, IMAGE_SIZE, CHANNELS))
+        y.set_shape((None,))
+        return x, y
+
+    def prepare(x, y):
+        x = tf.cast(x, tf.float32) / 255
+        if training and augment:
+            x = augment_image(x)
+        return x, y
+
+    dataset = tf.data.Dataset.from_tensor_slices(np.asarray(indices)).batch(READ_CHUNK)
+    dataset = dataset.map(read, num_parallel_calls=tf.data.AUTOTUNE).unbatch().cache()
+    if training:
+        # the indices are already shuffled (shuffle_data), the buffer reshuffles them every epoch
+        dataset = dataset.shuffle(SHUFFLE_BUFFER, reshuffle_each_iteration=True)
+    dataset = dataset.map(prepare, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+# Random flip, crop and colour jitter of a [0, 1] image, computed on the fly so no augmented copy is ever stored
+def augment_image(image):
+    image = tf.image.random_flip_left_right(image)
+    crop_size = int(IMAGE_SIZE * CROP_FRACTION)
+    image = tf.image.random_crop(image, (crop_size, crop_size, CHANNELS))
+    image = tf.image.resize(image, (IMAGE_SIZE, IMAGE_SIZE))
+    # no hue jitter, the images are BGR (cv2.imread) and hue depends on the channels' order, the others don't
+    image = tf.image.random_brightness(image, 0.1)
+    image = tf.image.random_contrast(image, 0.9, 1.1)
+    image = tf.image.random_saturation(image, 0.9, 1.1)
+    return tf.clip_by_value(image, 0, 1)
 
 
 def split_data(data):
@@ -89,27 +100,11 @@ def create_model():
     return model
 
 
-def train_model(model, train_data, val_data, epochs=20, batch_size=32):
-    X_train = []
-    y_train = []
-    X_val = []
-    y_val = []
-
-    for features, label in train_data:
-        X_train.append(features)
-        y_train.append(label)
-
-    for features, label in val_data:
-        X_val.append(features)
-        y_val.append(label)
-
-    X_train = np.array(X_train) / 255  # convert to np array and normalizes
-    y_train = np.array(y_train)  # convert to np array
+def train_model(model, images, labels, train_indices, val_indices, epochs=20, batch_size=32, augment=False):
+    train_batches = make_dataset(images, labels, train_indices, batch_size, augment=augment)
+    val_batches = make_dataset(images, labels, val_indices, batch_size, training=False)
 
-    X_val = np.array(X_val) / 255  # convert to np array and normalizes
-    y_val = np.array(y_val)  # convert to np array
-
-    hist = model.fit(X_train, y_train, epochs=epochs, batch_size=batch_size, validation_data=(X_val, y_val))
+    hist = model.fit(train_batches, epochs=epochs, validation_data=val_batches)
     return model, hist
 
 
@@ -148,37 +143,32 @@ def display_train_progression(hist):
     plt.show()
 
 
-def test_model(model, test_data):
+def test_model(model, images, labels, test_indices):
     success = 0
 
-    X_test = []
-    y_test = []
-
-    for features, label in test_data:
-        X_test.append(features)
-        y_test.append(label)
-
-    X_test = np.array(X_test) / 255  # converts to np array and normalizes
+    # sorted, so the batches keep the order of y_test
+    test_indices = np.sort(test_indices)
+    y_test = labels[test_indices]
 
-    yhat = model.predict(X_test)
+    yhat = model.predict(make_dataset(images, labels, test_indices, training=False))
     yhat = np.argmax(yhat, axis=1)
 
-    for i in range(len(X_test)):
+    for i in range(len(y_test)):
         if y_test[i] == yhat[i]:
             success += 1
 
-    return success / len(X_test)
+    return success / len(y_test)
 
 
 def main():
-    # pickle_the_dataset(DATASET_PATH, 'Pickle_Jar/data.pickle')
-    data = unpickle_data('Pickle_Jar/data.pickle')
-    shuffled_data = shuffle_data(data)
-    train_data, val_data, test_data = split_data(shuffled_data)
+    # brings the packed dataset up to date (only the added or changed images are decoded), then memory maps it
+    images, labels, _ = load_dataset(DATASET_PATH)
+    shuffled_indices = shuffle_data(len(images))
+    train_indices, val_indices, test_indices = split_data(shuffled_indices)
     model = create_model()
-    model, hist = train_model(model, train_data, val_data)
+    model, hist = train_model(model, images, labels, train_indices, val_indices)
     display_train_progression(hist)
-    success_rate = round(test_model(model, test_data), 4)
+    success_rate = round(test_model(model, images, labels, test_indices), 4)
     print(f'Success percentage in testing: {success_rate * 100}%')
     save_model(model, 'top_model', 'models')
     # print(f'Model Architecture:')
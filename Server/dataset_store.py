@@ -0,0 +1,261 @@
+import numpy as np
+from multiprocessing import Pool
+import hashlib
+import json
+import uuid
+import sys
+import cv2
+import os
+
+
+# Packed dataset store: the images of a directory of class directories (like Dataset and Test), decoded and resized
+# once, in a single store directory:
+#   images-<generation>.npy  uint8 (N, IMAGE_SIZE, IMAGE_SIZE, CHANNELS), BGR like cv2.imread
+#   labels-<generation>.npy  the class index of every image
+#   manifest.json            the class names (the labels index them), the images' shape, the names of the images
+#                            and labels files and the packed files, one per row of the images, with their path
+#                            (relative to the dataset), size, modification time and content hash, and the files that
+#                            couldn't be decoded, which are only tried again once they change
+# A pack writes new images and labels files and then replaces manifest.json, which is the only file that's replaced,
+# so a pack that fails at any point leaves the previous store as it was (the files it wrote stay behind), and a pack
+# that finds nothing to change writes nothing
+# open_dataset memory maps the images file, so opening the store is instant and only the images that are read are paged
+# into memory. create_model.py, captcha_generator.py and the evaluation tools all read the images through here
+# Packing is incremental: only the files that were added or whose content changed are decoded, the rows of the
+# unchanged ones are copied from the previous store and the deleted ones are dropped
+# The images are decoded by a pool of processes, in chunks of consecutive rows that every process writes straight into
+# the memory mapped images file, so the decoded images are never pickled back to the main process
+# Usage: python dataset_store.py [dataset path] (packs Dataset and Test by default)
+
+IMAGE_SIZE = 100
+CHANNELS = 3  # for colored images
+STORES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Packed')  # Server/Packed
+COPY_CHUNK = 256  # rows copied from the previous store at a time
+DECODE_CHUNK = 32  # images decoded by a process per task
+
+
+def store_path_of(dataset_path):
+    return os.path.join(STORES_PATH, os.path.basename(os.path.normpath(dataset_path)))
+
+
+def read_manifest(store_path):
+    manifest_path = os.path.join(store_path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    # a store of another image size (or format) can't be reused
+    if manifest.get('image_shape') != [IMAGE_SIZE, IMAGE_SIZE, CHANNELS] or 'images_file' not in manifest:
+        return None
+    return manifest
+
+
+# Removes the images and labels files of a replaced manifest, unless the current manifest still names them (it may
+# have been written by another pack that ran at the same time)
+# Only the replaced manifest's files are removed, a file that no manifest names yet may be another pack's in progress
+def remove_replaced_files(store_path, replaced_manifest):
+    current_manifest = read_manifest(store_path)
+    current_files = (current_manifest['images_file'], current_manifest['labels_file']) if current_manifest else ()
+    for file_name in (replaced_manifest['images_file'], replaced_manifest['labels_file']):
+        if file_name not in current_files:
+            try:
+                os.remove(os.path.join(store_path, file_name))
+            except OSError:
+                pass  # already removed, or still memory mapped somewhere (Windows)
+
+
+def file_hash(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+# The manifest entry of a file, its content is only hashed again if its size or modification time changed
+def file_entry(dataset_path, relative_path, previous_entry=None):
+    status = os.stat(os.path.join(dataset_path, relative_path))
+    entry = {'path': relative_path, 'size': status.st_size, 'mtime': status.st_mtime_ns}
+    if previous_entry is not None and (previous_entry['size'], previous_entry['mtime']) == (entry['size'], entry['mtime']):
+        entry['hash'] = previous_entry['hash']
+    else:
+        entry['hash'] = file_hash(os.path.join(dataset_path, relative_path))
+    return entry
+
+
+def initialize_decoder():
+    # the processes already use every core, OpenCV's own threads would only compete with them
+    cv2.setNumThreads(1)
+
+
+# Decodes and resizes the images at image_paths into the rows from first_row on of the images file
+# Returns the errors of the unreadable images, by their index in image_paths
+def decode_chunk(task):
+    images_path, image_paths, first_row = task
+    images = np.load(images_path, mmap_mode='r+')
+    errors = {}
+    for index, image_path in enumerate(image_paths):
+        try:
+            # the np array representation of the image, reshaped to 100x100
+            images[first_row + index] = cv2.resize(cv2.imread(image_path), (IMAGE_SIZE, IMAGE_SIZE))
+        except Exception as e:
+            errors[index] = str(e)
+    images.flush()
+    return errors
+
+
+# Decodes the images at image_paths into the rows from first_row on of the images file, with workers processes
+# Returns the errors of the unreadable images, by their index in image_paths
+def decode_images(images_path, image_paths, first_row, workers=None):
+    workers = min(workers or os.cpu_count() or 1, -(-len(image_paths) // DECODE_CHUNK))
+    tasks = [(images_path, image_paths[start: start + DECODE_CHUNK], first_row + start)
+             for start in range(0, len(image_paths), DECODE_CHUNK)]
+    if workers <= 1:
+        results = map(decode_chunk, tasks)
+    else:
+        pool = Pool(workers, initialize_decoder)
+        results = pool.imap(decode_chunk, tasks)
+
+    errors = {}
+    try:
+        # the chunks' results come back in the tasks' order
+        for (_, _, chunk_first_row), chunk_errors in zip(tasks, results):
+            for index, error in chunk_errors.items():
+                errors[chunk_first_row - first_row + index] = error
+    finally:
+        if workers > 1:
+            pool.close()
+            pool.join()
+    return errors
+
+
+# Brings the store at store_path up to date with the images of dataset_path
+# class_names fixes the label order, so a test set can be labeled like the training set (whose order is os.listdir's)
+# without it the store keeps its class order and new class directories are added after its classes
+def pack_dataset(dataset_path, store_path, class_names=None, workers=None):
+    manifest = read_manifest(store_path)
+    previous_entries = manifest['files'] if manifest is not None else []
+    previous_failed = {entry['path']: entry for entry in manifest['failed']} if manifest is not None else {}
+    if class_names is None:
+        class_names = list(manifest['class_names']) if manifest is not None else []
+        class_names += [class_name for class_name in os.listdir(dataset_path) if class_name not in class_names]
+    previous_rows = {entry['path']: row for row, entry in enumerate(previous_entries)}
+
+    # the files whose content is already in the previous store keep their rows, the others are decoded, except the
+    # ones that already failed to decode with the same content
+    reused, added, failed = [], [], []  # (previous row, entry, label), (entry, label) and entry
+    scanned_paths = set()
+    for class_index, class_name in enumerate(class_names):
+        class_path = os.path.join(dataset_path, class_name)  # path to the current class' directory
+        if not os.path.isdir(class_path):
+            continue
+        for image_name in os.listdir(class_path):
+            relative_path = f'{class_name}/{image_name}'
+            scanned_paths.add(relative_path)
+            previous_row = previous_rows.get(relative_path)
+            previous_entry = previous_entries[previous_row] if previous_row is not None else \
+                previous_failed.get(relative_path)
+            entry = file_entry(dataset_path, relative_path, previous_entry)
+            if previous_entry is not None and previous_entry['hash'] == entry['hash']:
+                if previous_row is None:
+                    failed.append({**entry, 'failed': True})
+                else:
+                    reused.append((previous_row, entry, class_index))
+            else:
+                added.append((entry, class_index))
+    # in the previous store's order, so the rows are copied front to back
+    reused.sort(key=lambda item: item[0])
+    deleted_amount = sum(entry['path'] not in scanned_paths for entry in previous_entries)
+
+    # nothing changed, the store is left as it is (so the files a concurrent open_dataset is reading stay in place)
+    if manifest is not None and not added and [entry for _, entry, _ in reused] == previous_entries and \
+            failed == manifest['failed'] and list(class_names) == manifest['class_names']:
+        return {'reused': len(reused), 'decoded': 0, 'deleted': 0, 'errors': len(failed)}
+
+    os.makedirs(store_path, exist_ok=True)
+    generation = uuid.uuid4().hex
+    images_file = manifest['images_file'] if manifest is not None else None
+    errors = {}
+    if added or len(reused) < len(previous_entries) or manifest is None:
+        # the images are written straight into the memory mapped file, the whole dataset is never in memory
+        images_file = f'images-{generation}.npy'
+        new_images_path = os.path.join(store_path, images_file)
+        images = np.lib.format.open_memmap(new_images_path, mode='w+', dtype=np.uint8,
+                                           shape=(len(reused) + len(added), IMAGE_SIZE, IMAGE_SIZE, CHANNELS))
+        if reused:
+            previous_images = np.load(os.path.join(store_path, manifest['images_file']), mmap_mode='r')
+            previous_row_indices = np.array([previous_row for previous_row, _, _ in reused])
+            for start in range(0, len(reused), COPY_CHUNK):
+                chunk = previous_row_indices[start: start + COPY_CHUNK]
+                images[start: start + len(chunk)] = previous_images[chunk]
+            del previous_images
+        images.flush()
+
+        image_paths = [os.path.join(dataset_path, entry['path']) for entry, _ in added]
+        errors = decode_images(new_images_path, image_paths, len(reused), workers)
+        if errors:
+            # the unreadable images are dropped, the rows after them move up, and the rows left at the end of the
+            # file are cut off by open_dataset
+            row = len(reused)
+            for index in range(len(added)):
+                if index not in errors:
+                    if row != len(reused) + index:
+                        images[row] = images[len(reused) + index]
+                    row += 1
+            for index, error in sorted(errors.items()):
+                print(f'{image_paths[index]}: {error}')
+                failed.append({**added[index][0], 'failed': True})
+        images.flush()
+        del images
+
+    # the labels are rewritten either way, the class order may have changed
+    kept = [(entry, label) for _, entry, label in reused] + \
+           [item for index, item in enumerate(added) if index not in errors]
+    labels_file = f'labels-{generation}.npy'
+    np.save(os.path.join(store_path, labels_file), np.array([label for _, label in kept], dtype=np.int32))
+    new_manifest = {'class_names': list(class_names), 'images_amount': len(kept),
+                    'image_shape': [IMAGE_SIZE, IMAGE_SIZE, CHANNELS], 'images_file': images_file,
+                    'labels_file': labels_file, 'files': [entry for entry, _ in kept], 'failed': failed}
+    # the new store only takes the old one's place once all its files are written, the temporary file is this
+    # process' own so packs that run at the same time don't write into each other's
+    temporary_manifest_path = os.path.join(store_path, f'manifest.{os.getpid()}.tmp.json')
+    with open(temporary_manifest_path, 'w') as manifest_file:
+        json.dump(new_manifest, manifest_file, indent=2)
+    os.replace(temporary_manifest_path, os.path.join(store_path, 'manifest.json'))
+    if manifest is not None:
+        remove_replaced_files(store_path, manifest)
+
+    return {'reused': len(reused), 'decoded': len(added) - len(errors), 'deleted': deleted_amount,
+            'errors': len(failed)}
+
+
+# Returns the memory mapped images, the labels and the class names of a store
+def open_dataset(store_path, attempts=3):
+    for attempt in range(attempts):
+        with open(os.path.join(store_path, 'manifest.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+        try:
+            images = np.load(os.path.join(store_path, manifest['images_file']), mmap_mode='r')
+            labels = np.load(os.path.join(store_path, manifest['labels_file']))
+            return images[: manifest['images_amount']], labels, manifest['class_names']
+        except FileNotFoundError:
+            # a pack replaced the manifest (and removed its files) after it was read, the new one is read again
+            if attempt + 1 == attempts:
+                raise
+
+
+# Opens the store of dataset_path, after bringing it up to date (which only decodes the added or changed images)
+def load_dataset(dataset_path, class_names=None, workers=None):
+    store_path = store_path_of(dataset_path)
+    pack_dataset(dataset_path, store_path, class_names, workers)
+    return open_dataset(store_path)
+
+
+def main():
+    # the test set is labeled with the training set's class order, which is the one the model's outputs follow
+    class_names = os.listdir('Dataset')
+    for dataset_path in sys.argv[1:] or ['Dataset', 'Test']:
+        statistics = pack_dataset(dataset_path, store_path_of(dataset_path), class_names)
+        print(f'{dataset_path}: {statistics["decoded"]} images decoded, {statistics["reused"]} unchanged,'
+              f' {statistics["deleted"]} deleted, {statistics["errors"]} unreadable')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,62 +3,125 @@ import numpy as np
 
 
 # Base Activation
+# activation and activation_prime write their result into the given out array (a new array if out is None)
+# output_prime, when given, is the derivative computed from the activation's output Y = f(X) instead of X,
+# so backward reuses the cached output instead of computing f(X) again
 class Activation(Layer):
-    def __init__(self, activation, activation_prime):
+    def __init__(self, activation, activation_prime, output_prime=None):
         self.activation = activation
         self.activation_prime = activation_prime
+        self.output_prime = output_prime
 
-    def forward(self, input):
-        self.input = input
-        self.output = self.activation(self.input)
-        return self.output
+    def forward(self, input, train=True):
+        output = self.activation(input, out=self.buffer('output', input.shape, input.dtype))
+        if train:
+            self.input, self.output = input, output
+        return output
 
     def backward(self, output_gradient, learning_rate):
         # Hadamard Product (⊙ or *) is element wise multiplication
-        input_gradient = output_gradient * self.activation_prime(self.input)  # dE/dX = dE/dY ⊙ dY/dX
+        input_gradient = self.buffer('input_gradient', self.input.shape, self.input.dtype)
+        if self.output_prime is not None:
+            input_gradient = self.output_prime(self.output, out=input_gradient)
+        else:
+            input_gradient = self.activation_prime(self.input, out=input_gradient)
+        input_gradient *= output_gradient  # dE/dX = dE/dY ⊙ dY/dX
         return input_gradient
 
 
 # Hyperbolic Tangent (tanh) activation function and its derivative
 class Tanh(Activation):
     def __init__(self):
-        tanh = lambda x: np.tanh(x)  # f(x) = tanh(x)
-        tanh_prime = lambda x: 1 - np.tanh(x) ** 2  # f'(x) = 1 - tanh(x)^2
-        super().__init__(tanh, tanh_prime)
+        tanh = lambda x, out=None: np.tanh(x, out=out)  # f(x) = tanh(x)
+
+        def tanh_prime(x, out=None):
+            # f'(x) = 1 - tanh(x)^2
+            out = np.tanh(x, out=out)
+            np.square(out, out=out)
+            return np.subtract(1, out, out=out)
+
+        def tanh_output_prime(y, out=None):
+            # f'(x) = 1 - y^2
+            out = np.square(y, out=out)
+            return np.subtract(1, out, out=out)
+
+        super().__init__(tanh, tanh_prime, tanh_output_prime)
 
 
 # Sigmoid activation function and its derivative
 class Sigmoid(Activation):
     def __init__(self):
         # f(x) = 1 / (1 + e^(-x))
-        def sigmoid(x):
-            # Clip x to a reasonable range
-            x = np.clip(x, -700, 700)
-            return 1 / (1 + np.exp(-x))
+        def sigmoid(x, out=None):
+            # Clip x to a range where e^(-x) can't overflow in x's dtype
+            limit = float(np.floor(np.log(np.finfo(x.dtype).max)))
+            out = np.clip(x, -limit, limit, out=out)
+            np.negative(out, out=out)
+            np.exp(out, out=out)
+            out += 1
+            return np.reciprocal(out, out=out)
+
+        def sigmoid_prime(x, out=None):
+            # f'(x) = f(x) * (1 - f(x))
+            out = sigmoid(x, out=out)
+            out *= 1 - out
+            return out
+
+        def sigmoid_output_prime(y, out=None):
+            # f'(x) = y * (1 - y)
+            out = np.subtract(1, y, out=out)
+            out *= y
+            return out
 
-        sigmoid_prime = lambda x: sigmoid(x) * (1 - sigmoid(x))  # f'(x) = f(x) * (1 - f(x))
-        super().__init__(sigmoid, sigmoid_prime)
+        super().__init__(sigmoid, sigmoid_prime, sigmoid_output_prime)
 
 
 # Rectified Linear Unit (ReLU) activation function and its derivative
 class ReLU(Activation):
     def __init__(self):
-        relu = lambda x: x * (x > 0).astype(int)
-        relu_prime = lambda x: (x > 0).astype(int)
-        super().__init__(relu, relu_prime)
+        # the results are kept in x's dtype, so no int64 temporaries are created and nothing is upcast
+        relu = lambda x, out=None: np.maximum(x, 0, out=out)
+
+        def relu_prime(x, out=None):
+            if out is None:
+                out = np.empty_like(x)
+            return np.greater(x, 0, out=out)
+
+        # y > 0 exactly where x > 0
+        super().__init__(relu, relu_prime, relu_prime)
 
 
 # Softmax activation forward and backward (unlike the others, it can't use the super's forward and backward)
+# the input is a batch of (n, 1) column vectors, each one is normalized separately along axis -2
 class Softmax(Layer):
-    def forward(self, input):
-        self.input = input
+    def forward(self, input, train=True):
+        output = self.buffer('output', input.shape, input.dtype)
+        totals = self.buffer('totals', (len(input), 1, 1), input.dtype)
         # normalize the input to be between -∞ and 0 instead of between -∞ and ∞
-        normalized_input = self.input - np.max(self.input)
-        tmp = np.exp(normalized_input)
-        self.output = tmp / np.sum(tmp)
-        return self.output
+        np.max(input, axis=-2, keepdims=True, out=totals)
+        np.subtract(input, totals, out=output)
+        np.exp(output, out=output)
+        np.sum(output, axis=-2, keepdims=True, out=totals)
+        output /= totals
+        if train:
+            self.input, self.output = input, output
+        return output
 
     def backward(self, output_gradient, learning_rate):
-        n = np.size(self.output)
-        input_gradient = np.dot(self.output * (np.identity(n) - self.output.T), output_gradient)
+        # dE/dX = (Y ⊙ (I - transposed(Y))) · dE/dY = Y ⊙ (dE/dY - Σ(Y[i] * dE/dY[i]))
+        # the n x n jacobian is never built, its product with the gradient is O(n)
+        input_gradient = self.buffer('input_gradient', self.output.shape, self.output.dtype)
+        totals = self.buffer('totals', (len(self.output), 1, 1), self.output.dtype)
+        np.multiply(self.output, output_gradient, out=input_gradient)
+        np.sum(input_gradient, axis=-2, keepdims=True, out=totals)
+        np.subtract(output_gradient, totals, out=input_gradient)
+        input_gradient *= self.output
         return input_gradient
+
+
+# Softmax output layer that must be paired with a fused softmax cross entropy loss
+# (losses.SoftmaxCrossEntropy or losses.SparseSoftmaxCrossEntropy)
+# The loss's prime is already the gradient of the softmax's input (Y - one hot), so backward passes it through
+class FusedSoftmax(Softmax):
+    def backward(self, output_gradient, learning_rate):
+        return output_gradient
@@ -0,0 +1,169 @@
+import numpy as np
+import argparse
+import platform
+import timeit
+import json
+import sys
+import os
+from layers import Convolutional, Dense, Dropout, Flatten, Reshape, MaxPooling
+from activations import Tanh, Sigmoid, ReLU, Softmax, FusedSoftmax
+from losses import (MeanSquaredError, BinaryCrossEntropy, CategoricalCrossEntropy, SparseCategoricalCrossEntropy,
+                    SoftmaxCrossEntropy, SparseSoftmaxCrossEntropy)
+from dtypes import set_default_dtype, get_default_dtype
+
+
+# Micro benchmarks of the forward and backward pass of every layer, activation and loss
+# at the MNIST (1, 28, 28) and the CAPTCHA tile (3, 100, 100) input shapes, over several batch sizes
+# The timings are written to a JSON file and compared against a baseline file, e.g.:
+#   python benchmark_layers.py --save-baseline        (on the reference commit)
+#   python benchmark_layers.py                        (after a change, prints the speedup of every benchmark)
+# The baseline is machine specific, so it's only meaningful when both runs happen on the same machine
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(DIRECTORY, 'benchmark_results.json')
+DEFAULT_BASELINE = os.path.join(DIRECTORY, 'benchmark_baseline.json')
+
+WORKLOADS = {'mnist': (1, 28, 28), 'captcha': (3, 100, 100)}
+BATCH_SIZES = (1, 16, 64)
+CLASSES = 10
+FILTERS_AMOUNT = 8
+DENSE_OUTPUT_SIZE = 64
+
+
+# A benchmark is a (name, forward, backward) triple, the functions take no arguments
+# forward is run once before backward is timed, so the layers have the caches backward needs
+def layer_benchmark(name, layer, input):
+    output = layer.forward(input)
+    output_gradient = np.random.randn(*output.shape).astype(output.dtype)
+    return name, lambda: layer.forward(input), lambda: layer.backward(output_gradient, None)
+
+
+def loss_benchmark(name, loss, loss_prime, y_true, y_pred):
+    return name, lambda: loss(y_true, y_pred), lambda: loss_prime(y_true, y_pred)
+
+
+def create_benchmarks(workload, input_shape, batch_size):
+    dtype = get_default_dtype()
+    depth, height, width = input_shape
+    input = np.random.rand(batch_size, *input_shape).astype(dtype)
+    convolution_shape = (FILTERS_AMOUNT, height - 2, width - 2)
+    convolution_output = np.random.randn(batch_size, *convolution_shape).astype(dtype)
+    flat_size = depth * height * width
+    flat_input = input.reshape(batch_size, flat_size, 1)
+    scores = np.random.randn(batch_size, CLASSES, 1).astype(dtype)
+
+    # normalized class probabilities and their labels, for the losses
+    probabilities = np.exp(scores)
+    probabilities /= np.sum(probabilities, axis=-2, keepdims=True)
+    labels = np.random.randint(0, CLASSES, batch_size)
+    one_hot = np.zeros_like(probabilities)
+    one_hot[np.arange(batch_size), labels] = 1
+
+    benchmarks = [layer_benchmark(f'Convolutional[{backend}]', Convolutional(input_shape, 3, 3, FILTERS_AMOUNT, backend), input)
+                  for backend in ('direct', 'im2col', 'fft')]
+    benchmarks += [
+        layer_benchmark('Dense', Dense(flat_size, DENSE_OUTPUT_SIZE), flat_input),
+        layer_benchmark('Dropout', Dropout(0.5), convolution_output),
+        layer_benchmark('Flatten', Flatten(input_shape), input),
+        layer_benchmark('Reshape', Reshape(input_shape, (depth, height * width)), input),
+        layer_benchmark('MaxPooling', MaxPooling((2, 2)), convolution_output),
+        layer_benchmark('Tanh', Tanh(), convolution_output),
+        layer_benchmark('Sigmoid', Sigmoid(), convolution_output),
+        layer_benchmark('ReLU', ReLU(), convolution_output),
+        layer_benchmark('Softmax', Softmax(), scores),
+        layer_benchmark('FusedSoftmax', FusedSoftmax(), scores),
+        loss_benchmark('MeanSquaredError', MeanSquaredError.mean_squared_error,
+                       MeanSquaredError.mean_squared_error_prime, one_hot, probabilities),
+        loss_benchmark('BinaryCrossEntropy', BinaryCrossEntropy.binary_cross_entropy,
+                       BinaryCrossEntropy.binary_cross_entropy_prime, one_hot, probabilities),
+        loss_benchmark('CategoricalCrossEntropy', CategoricalCrossEntropy.categorical_cross_entropy,
+                       CategoricalCrossEntropy.categorical_cross_entropy_prime, one_hot, probabilities),
+        loss_benchmark('SparseCategoricalCrossEntropy', SparseCategoricalCrossEntropy.sparse_categorical_cross_entropy,
+                       SparseCategoricalCrossEntropy.sparse_categorical_cross_entropy_prime, labels, probabilities),
+        loss_benchmark('SoftmaxCrossEntropy', SoftmaxCrossEntropy.softmax_cross_entropy,
+                       SoftmaxCrossEntropy.softmax_cross_entropy_prime, one_hot, probabilities),
+        loss_benchmark('SparseSoftmaxCrossEntropy', SparseSoftmaxCrossEntropy.sparse_softmax_cross_entropy,
+                       SparseSoftmaxCrossEntropy.sparse_softmax_cross_entropy_prime, labels, probabilities),
+    ]
+    return [(f'{name} {workload} batch {batch_size}', forward, backward) for name, forward, backward in benchmarks]
+
+
+# The best time of one call out of repeat measurements, each of them long enough to be measured reliably
+def measure(function, repeat):
+    function()  # warm up, plans the buffers
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def run(batch_sizes, name_filter, repeat):
+    results = {}
+    for workload, input_shape in WORKLOADS.items():
+        for batch_size in batch_sizes:
+            for name, forward, backward in create_benchmarks(workload, input_shape, batch_size):
+                if name_filter and name_filter not in name:
+                    continue
+                results[name] = {'forward': measure(forward, repeat), 'backward': measure(backward, repeat)}
+                print(f'{name:<56}forward {results[name]["forward"] * 1000:>10.4f} ms'
+                      f'   backward {results[name]["backward"] * 1000:>10.4f} ms')
+    return results
+
+
+# Prints the speedup (baseline time / current time) of every benchmark both runs have
+# Returns the names of the benchmarks that got slower by more than threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f'\n{"benchmark":<56}{"forward":>12}{"backward":>12}')
+    for name, timings in results.items():
+        if name not in baseline:
+            continue
+        speedups = {phase: baseline[name][phase] / timings[phase] for phase in ('forward', 'backward')}
+        marks = ''
+        if any(speedup < 1 / (1 + threshold) for speedup in speedups.values()):
+            regressions.append(name)
+            marks = '  slower'
+        print(f'{name:<56}{speedups["forward"]:>11.2f}x{speedups["backward"]:>11.2f}x{marks}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the forward and backward pass of every layer and loss')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='the JSON file the results are written to')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='the JSON file the results are compared against')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file too')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=BATCH_SIZES)
+    parser.add_argument('--filter', default='', help='only run the benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dtype', default='float32')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='the relative slowdown above which a benchmark counts as a regression')
+    arguments = parser.parse_args()
+
+    set_default_dtype(arguments.dtype)
+    np.random.seed(0)
+    report = {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                        'processor': platform.processor(), 'dtype': arguments.dtype},
+        'results': run(arguments.batch_sizes, arguments.filter, arguments.repeat),
+    }
+
+    with open(arguments.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    if arguments.save_baseline:
+        with open(arguments.baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        return
+
+    if os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['environment'] != report['environment']:
+            print('\nThe baseline was measured in a different environment:', baseline['environment'])
+        regressions = compare(report['results'], baseline['results'], arguments.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} benchmarks are more than {arguments.threshold:.0%} slower than the baseline')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+import numpy as np
+import time
+import json
+import os
+from numpy.lib.stride_tricks import as_strided
+from workspace import Workspace
+
+
+# The (height, width) of a valid correlation of a (height, width) input with a kernel, moved stride pixels at a time
+def correlation_shape(height, width, kernel_height, kernel_width, stride=(1, 1)):
+    return (height - kernel_height) // stride[0] + 1, (width - kernel_width) // stride[1] + 1
+
+
+# Unfolds every (kernel_height x kernel_width) window of a (N, C, H, W) batch into a column
+# The result is a (C * kernel_height * kernel_width, N * output_height * output_width) matrix,
+# so a whole batched correlation becomes a single matrix multiplication with the flattened filters
+# With a stride only the windows the correlation keeps are unfolded
+# When out is given the columns are written into it instead of a new array
+def im2col(input, kernel_height, kernel_width, stride=(1, 1), out=None):
+    batch_size, depth, height, width = input.shape
+    output_height, output_width = correlation_shape(height, width, kernel_height, kernel_width, stride)
+    batch_stride, depth_stride, row_stride, col_stride = input.strides
+    # a read only strided view of the windows, no data is copied until the reshape (or copy) below
+    windows = as_strided(input,
+                         shape=(depth, kernel_height, kernel_width, batch_size, output_height, output_width),
+                         strides=(depth_stride, row_stride, col_stride, batch_stride,
+                                  row_stride * stride[0], col_stride * stride[1]),
+                         writeable=False)
+    if out is None:
+        return windows.reshape(depth * kernel_height * kernel_width, batch_size * output_height * output_width)
+    np.copyto(out.reshape(windows.shape), windows)
+    return out
+
+
+# The adjoint of im2col, adds every column back onto the window of the (N, C, H, W) out array it was unfolded from
+def col2im(columns, kernel_height, kernel_width, stride, out):
+    batch_size, depth, height, width = out.shape
+    output_height, output_width = correlation_shape(height, width, kernel_height, kernel_width, stride)
+    windows = columns.reshape(depth, kernel_height, kernel_width, batch_size, output_height, output_width)
+    out.fill(0)
+    # one strided addition per kernel position, each covers every window at once
+    for row in range(kernel_height):
+        for col in range(kernel_width):
+            out[:, :, row: row + stride[0] * (output_height - 1) + 1: stride[0],
+                col: col + stride[1] * (output_width - 1) + 1: stride[1]] += windows[:, row, col].transpose(1, 0, 2, 3)
+    return out
+
+
+# Spreads a strided correlation's output gradient over the positions of the stride 1 correlation, with 0 in between
+# The backends that can't skip positions compute the strided gradients as the stride 1 gradients of this array
+# Only the kept positions are ever written, so the rest of the buffer stays 0
+def dilate(output_gradient, input_shape, kernel_shape, stride, out_buffer):
+    if stride == (1, 1):
+        return output_gradient
+    dilated = out_buffer('dilated_output_gradient', (*output_gradient.shape[: 2], *correlation_shape(*input_shape, *kernel_shape)),
+                         output_gradient.dtype)
+    dilated[:, :, :: stride[0], :: stride[1]] = output_gradient
+    return dilated
+
+
+# Every backend's forward returns Y, its backward writes dE/dF into the given filters_gradient array and returns dE/dX
+# An inference forward (train=False) writes into buffers of its own, so it never overwrites what the backward of the
+# last training forward reads
+# stride is a (row stride, column stride) pair, the layer pads the input before it's handed to the backend
+
+# Reference backend, slides every kernel separately using scipy (slow, but easy to verify)
+# scipy is imported on the first use, importing it takes longer than the rest of the library and only this backend
+# needs it
+class DirectBackend(Workspace):
+    def forward(self, input, filters, biases, stride=(1, 1), train=True):
+        from scipy import signal
+
+        filters_amount, kernels_per_filter = filters.shape[: 2]
+        output = self.buffer('output' if train else 'inference_output', (len(input), *biases.shape), input.dtype)
+
+        # a strided correlation keeps every stride-th position of the stride 1 correlation
+        for sample_index, sample in enumerate(input):
+            output[sample_index] = biases
+            for filter_index in range(filters_amount):
+                for kernel_index in range(kernels_per_filter):
+                    output[sample_index, filter_index] += \
+                        signal.correlate2d(sample[kernel_index], filters[filter_index, kernel_index], 'valid')[:: stride[0], :: stride[1]]
+
+        return output
+
+    def backward(self, input, filters, output_gradient, filters_gradient, stride=(1, 1)):
+        # Cross-Correlation (★) is sliding a kernel across an image
+        # Convolution (∗) is sliding a flipped (180° rotated) kernel across an image
+        # i is the index of the filter, j is the index of the kernel within the filter
+        # the filters gradient is summed over the batch, the input gradient is kept per sample
+        # dE/dF[i][j] = X[j] ★ (dE/dY[i])
+        from scipy import signal
+
+        filters_amount, kernels_per_filter = filters.shape[: 2]
+        output_gradient = dilate(output_gradient, input.shape[2:], filters.shape[2:], stride, self.buffer)
+        input_gradient = self.buffer('input_gradient', input.shape, input.dtype)  # dE/dX[j] = Σ(i=1, i<filters amount)->(dE/dY[i] ∗full F[i][j])
+        filters_gradient.fill(0)
+        input_gradient.fill(0)
+
+        for sample_index, sample in enumerate(input):
+            for filter_index in range(filters_amount):
+                for kernel_index in range(kernels_per_filter):
+                    filters_gradient[filter_index, kernel_index] += \
+                        signal.correlate2d(sample[kernel_index], output_gradient[sample_index, filter_index], 'valid')
+                    input_gradient[sample_index, kernel_index] += \
+                        signal.convolve2d(output_gradient[sample_index, filter_index], filters[filter_index, kernel_index], 'full')
+
+        return input_gradient
+
+
+# im2col/GEMM backend, lowers the forward pass and both gradients to one matrix multiplication each for the whole batch
+# A stride shrinks all three products, only the windows of the kept positions are ever unfolded
+# Every intermediate matrix lives in a buffer that's reused by later batches of the same shape
+class Im2colBackend(Workspace):
+    def forward(self, input, filters, biases, stride=(1, 1), train=True):
+        filters_amount, kernels_per_filter, kernel_height, kernel_width = filters.shape
+        output_height, output_width = biases.shape[1:]
+        batch_size = len(input)
+        prefix = '' if train else 'inference_'
+        columns = self.buffer(prefix + 'columns', (kernels_per_filter * kernel_height * kernel_width,
+                                                   batch_size * output_height * output_width), input.dtype)
+        im2col(input, kernel_height, kernel_width, stride, out=columns)
+
+        # Y = F · cols + B, every row of F is one flattened filter
+        product = self.buffer(prefix + 'product', (filters_amount, len(columns[0])), input.dtype)
+        np.dot(filters.reshape(filters_amount, -1), columns, out=product)
+        output = self.buffer(prefix + 'output', (batch_size, *biases.shape), input.dtype)
+        np.add(product.reshape(filters_amount, batch_size, output_height, output_width).transpose(1, 0, 2, 3), biases, out=output)
+        return output
+
+    def backward(self, input, filters, output_gradient, filters_gradient, stride=(1, 1)):
+        filters_amount, kernels_per_filter, kernel_height, kernel_width = filters.shape
+        batch_size = len(input)
+        output_height, output_width = output_gradient.shape[2:]
+        dtype = output_gradient.dtype
+
+        # (N, F, H, W) -> (F, N * H * W) so it lines up with the columns of im2col
+        flat_output_gradient = self.buffer('flat_output_gradient', (filters_amount, batch_size * output_height * output_width), dtype)
+        np.copyto(flat_output_gradient.reshape(filters_amount, batch_size, output_height, output_width),
+                  output_gradient.transpose(1, 0, 2, 3))
+
+        # dE/dF = dE/dY · transposed(cols), the product also sums the gradient over the batch
+        # the columns are left over from the training forward pass of the same input
+        columns = self.buffer('columns', (kernels_per_filter * kernel_height * kernel_width, len(flat_output_gradient[0])), dtype)
+        np.dot(flat_output_gradient, columns.T, out=filters_gradient.reshape(filters_amount, -1))
+
+        # dE/dcols = transposed(F) · dE/dY, every column is the gradient of one window of X
+        # dE/dX is the sum of the windows' gradients, folded back onto the positions they were unfolded from
+        gradient_columns = self.buffer('gradient_columns', columns.shape, dtype)
+        np.dot(filters.reshape(filters_amount, -1).T, flat_output_gradient, out=gradient_columns)
+        input_gradient = self.buffer('input_gradient', input.shape, dtype)
+        col2im(gradient_columns, kernel_height, kernel_width, stride, out=input_gradient)
+
+        return input_gradient
+
+
+# FFT backend, correlates in the frequency domain, its cost barely depends on the kernel size
+# All three products are done on (H, W) sized transforms, which is large enough to avoid any wrap around
+# in the parts of the circular results that are kept
+# The transforms compute every position, so a stride only subsamples the stride 1 results
+class FFTBackend(Workspace):
+    def forward(self, input, filters, biases, stride=(1, 1), train=True):
+        input_height, input_width = input.shape[2:]
+        output_height, output_width = correlation_shape(input_height, input_width, *filters.shape[2:])
+        transform_shape = (input_height, input_width)
+
+        input_transform = np.fft.rfft2(input, s=transform_shape)
+        filters_transform = np.fft.rfft2(filters, s=transform_shape)
+        # X ★ F = ifft(fft(X) · conj(fft(F))), summed over the kernels of each filter
+        output_transform = frequency_product(input_transform, np.conj(filters_transform).transpose(1, 0, 2, 3))
+        output = np.fft.irfft2(output_transform, s=transform_shape)[:, :, : output_height: stride[0], : output_width: stride[1]]
+        # older numpy versions compute the transforms in double precision only
+        output = output.astype(input.dtype, copy=False)
+        output += biases
+        return output
+
+    def backward(self, input, filters, output_gradient, filters_gradient, stride=(1, 1)):
+        kernel_height, kernel_width = filters.shape[2:]
+        input_height, input_width = input.shape[2:]
+        transform_shape = (input_height, input_width)
+        output_gradient = dilate(output_gradient, input.shape[2:], filters.shape[2:], stride, self.buffer)
+
+        input_transform = np.fft.rfft2(input, s=transform_shape)
+        filters_transform = np.fft.rfft2(filters, s=transform_shape)
+        output_gradient_transform = np.fft.rfft2(output_gradient, s=transform_shape)
+
+        # dE/dF[i][j] = X[j] ★ (dE/dY[i]), summed over the batch
+        filters_gradient_transform = frequency_product(np.conj(output_gradient_transform).transpose(1, 0, 2, 3), input_transform)
+        filters_gradient[...] = np.fft.irfft2(filters_gradient_transform, s=transform_shape)[:, :, : kernel_height, : kernel_width]
+
+        # dE/dX[j] = Σ(i=1, i<filters amount)->(dE/dY[i] ∗full F[i][j])
+        input_gradient_transform = frequency_product(output_gradient_transform, filters_transform)
+        input_gradient = np.fft.irfft2(input_gradient_transform, s=transform_shape)
+
+        return input_gradient.astype(input.dtype, copy=False)
+
+
+# Multiplies (A, B, h, w) by (B, C, h, w) into (A, C, h, w), one matrix product per frequency
+def frequency_product(left, right):
+    product = np.matmul(left.transpose(2, 3, 0, 1), right.transpose(2, 3, 0, 1))
+    return product.transpose(2, 3, 0, 1)
+
+
+# Picks the fastest backend for each (input shape, filters shape) pair it sees
+# The choice is made by timing every candidate once and is cached on disk, so later runs skip the benchmark
+class AutoBackend:
+    candidates = ('im2col', 'fft')
+    calibration_path = os.environ.get('CONVOLUTION_CALIBRATION_PATH',
+                                      os.path.join(os.path.dirname(os.path.abspath(__file__)), 'convolution_calibration.json'))
+    repeats = 3
+
+    def __init__(self):
+        self.backends = {}  # calibration key -> chosen backend, for the shapes this layer has seen
+
+    def forward(self, input, filters, biases, stride=(1, 1), train=True):
+        return self.choose(input, filters, stride).forward(input, filters, biases, stride, train)
+
+    def backward(self, input, filters, output_gradient, filters_gradient, stride=(1, 1)):
+        return self.choose(input, filters, stride).backward(input, filters, output_gradient, filters_gradient, stride)
+
+    def choose(self, input, filters, stride=(1, 1)):
+        # the batch size is left out of the key, it scales all the candidates about the same
+        key = f"{'x'.join(map(str, input.shape[1:]))}-{'x'.join(map(str, filters.shape))}-{filters.dtype}"
+        if stride != (1, 1):
+            key += f"-stride{'x'.join(map(str, stride))}"
+        if key not in self.backends:
+            calibration = load_calibration(self.calibration_path)
+            if key not in calibration:
+                calibration[key] = self.calibrate(input, filters, stride)
+                save_calibration(self.calibration_path, calibration)
+            self.backends[key] = get_backend(calibration[key])
+        return self.backends[key]
+
+    def free_buffers(self):
+        for backend in self.backends.values():
+            backend.free_buffers()
+
+    def calibrate(self, input, filters, stride=(1, 1)):
+        input = np.random.randn(*input.shape).astype(input.dtype)
+        filters = np.random.randn(*filters.shape).astype(filters.dtype)
+        output_shape = (len(filters), *correlation_shape(*input.shape[2:], *filters.shape[2:], stride))
+        biases = np.random.randn(*output_shape).astype(filters.dtype)
+        output_gradient = np.random.randn(len(input), *output_shape).astype(filters.dtype)
+
+        timings = {}
+        for name in self.candidates:
+            backend = get_backend(name)
+            best = float('inf')
+            for _ in range(self.repeats):
+                start = time.perf_counter()
+                backend.forward(input, filters, biases, stride)
+                backend.backward(input, filters, output_gradient, np.empty_like(filters), stride)
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+
+        return min(timings, key=timings.get)
+
+
+# A missing or unreadable file is an empty calibration, its shapes are calibrated again
+def load_calibration(path):
+    try:
+        with open(path) as calibration_file:
+            return json.load(calibration_file)
+    except (OSError, ValueError):
+        return {}
+
+
+# Written to a temporary file of this process that replaces the file, so the processes of parallel training never
+# read a partly written file
+def save_calibration(path, calibration):
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as calibration_file:
+        json.dump(calibration, calibration_file, indent=4)
+    os.replace(temporary_path, path)
+
+
+BACKENDS = {
+    'direct': DirectBackend,
+    'im2col': Im2colBackend,
+    'fft': FFTBackend,
+    'auto': AutoBackend,
+}
+
+
+def get_backend(name):
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown convolution backend: {name}, expected one of {list(BACKENDS)}')
+    return BACKENDS[name]()
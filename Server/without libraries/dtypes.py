@@ -0,0 +1,41 @@
+import numpy as np
+
+
+# The floating point type new layers create their parameters in
+# float32 halves the memory traffic of float64 and lets BLAS run about twice as fast
+default_dtype = np.dtype(np.float32)
+
+
+def set_default_dtype(dtype):
+    global default_dtype
+    default_dtype = np.dtype(dtype)
+
+
+def get_default_dtype():
+    return default_dtype
+
+
+# The dtype of a network is the dtype of its parameters (layers without parameters follow their input)
+def network_dtype(network):
+    for layer in network:
+        if hasattr(layer, 'dtype'):
+            return layer.dtype
+    return default_dtype
+
+
+# Casts the parameters of every layer in the network, so the whole forward and backward pass runs in dtype
+# The gradient arrays are dropped with the old parameters (an optimizer has to be attached again)
+def set_network_dtype(network, dtype):
+    dtype = np.dtype(dtype)
+    for layer in network:
+        for name in layer.parameter_names:
+            setattr(layer, name, getattr(layer, name).astype(dtype))
+        layer.__dict__.pop('gradients', None)
+        if hasattr(layer, 'dtype'):
+            layer.dtype = dtype
+
+
+# Makes sure a layer didn't silently upcast (or downcast) the array that flows through the network
+def check_dtype(layer, array, dtype):
+    if array.dtype != dtype:
+        raise TypeError(f'{type(layer).__name__} returned {array.dtype} while the network runs in {dtype}')
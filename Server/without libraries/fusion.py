@@ -0,0 +1,85 @@
+from layers import Convolutional, Dense
+from activations import Tanh, Sigmoid, ReLU
+
+
+# Layer fusion: compile(network) replaces every Convolutional or Dense layer that is directly followed by an elementwise
+# activation with a single fused layer, which applies the activation in place on the layer's own output buffer
+# (no separate pass allocating a full size output) and computes the activation's derivative from that cached output
+# The fused layers keep the original layers' parameter names, so optimizers, parallel training and serialization
+# treat them like the unfused ones
+# Flatten and Reshape already are zero copy: the layers' outputs are contiguous buffers, so their reshapes are views
+
+FUSABLE_ACTIVATIONS = {'tanh': Tanh, 'sigmoid': Sigmoid, 'relu': ReLU}
+
+
+# Applies the activation in place on output, which is kept for backward (the pre-activation values aren't needed)
+def activate(layer, output):
+    return layer.activation.activation(output, out=output)
+
+
+# dE/dZ = dE/dY ⊙ f'(Z), where f'(Z) is computed from Y = f(Z)
+def activation_gradient(layer, output_gradient):
+    gradient = layer.activation.output_prime(layer.output, out=layer.buffer('activation_gradient', layer.output.shape,
+                                                                            layer.output.dtype))
+    gradient *= output_gradient
+    return gradient
+
+
+# Convolutional Layer + activation
+class FusedConvolutional(Convolutional):
+    def __init__(self, input_shape, kernel_height, kernel_width, filters_amount, activation, backend='im2col',
+                 initialize=True, stride=1, padding='valid'):
+        super().__init__(input_shape, kernel_height, kernel_width, filters_amount, backend, initialize, stride, padding)
+        self.activation_name = activation
+        self.activation = FUSABLE_ACTIVATIONS[activation]()
+
+    def get_config(self):
+        return {**super().get_config(), 'activation': self.activation_name}
+
+    def forward(self, input, train=True):
+        return activate(self, super().forward(input, train))
+
+    def backward(self, output_gradient, learning_rate):
+        return super().backward(activation_gradient(self, output_gradient), learning_rate)
+
+
+# Dense Layer + activation
+class FusedDense(Dense):
+    def __init__(self, input_size, output_size, activation, initialize=True):
+        super().__init__(input_size, output_size, initialize)
+        self.activation_name = activation
+        self.activation = FUSABLE_ACTIVATIONS[activation]()
+
+    def get_config(self):
+        return {**super().get_config(), 'activation': self.activation_name}
+
+    def forward(self, input, train=True):
+        return activate(self, super().forward(input, train))
+
+    def backward(self, output_gradient, learning_rate):
+        return super().backward(activation_gradient(self, output_gradient), learning_rate)
+
+
+FUSED_LAYERS = {Convolutional: FusedConvolutional, Dense: FusedDense}
+
+
+# Returns the fused network, its fused layers share the original layers' parameter arrays
+def compile(network):
+    activation_names = {activation_class: name for name, activation_class in FUSABLE_ACTIVATIONS.items()}
+    compiled_network = []
+    index = 0
+    while index < len(network):
+        layer = network[index]
+        following = network[index + 1] if index + 1 < len(network) else None
+        if type(layer) in FUSED_LAYERS and type(following) in activation_names:
+            fused_layer = FUSED_LAYERS[type(layer)](**layer.get_config(), activation=activation_names[type(following)],
+                                                    initialize=False)
+            for name in layer.parameter_names:
+                setattr(fused_layer, name, getattr(layer, name))
+            fused_layer.dtype = layer.dtype
+            compiled_network.append(fused_layer)
+            index += 2
+        else:
+            compiled_network.append(layer)
+            index += 1
+    return compiled_network
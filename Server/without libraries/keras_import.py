@@ -0,0 +1,140 @@
+import numpy as np
+import json
+import sys
+from layers import Convolutional, Dense, Dropout, Flatten, MaxPooling
+from activations import ReLU, Sigmoid, Tanh, Softmax
+from serialization import save
+
+
+# Converts a Keras Sequential model (Conv2D/MaxPooling2D/Dropout/Flatten/Dense in NHWC, like create_model.create_model)
+# into a network of this library's layers, which runs in NCHW
+# The .h5 file is read with h5py only, so neither the conversion nor the converted network needs TensorFlow
+
+ACTIVATIONS = {'relu': ReLU, 'sigmoid': Sigmoid, 'tanh': Tanh, 'softmax': Softmax, 'linear': None}
+
+
+# Returns the model's (height, width, channels) input shape and a (class name, config, weights) spec for every layer
+def read_h5(path):
+    import h5py  # only the conversion needs h5py
+
+    with h5py.File(path, 'r') as model_file:
+        model_config = model_file.attrs['model_config']
+        model_config = json.loads(model_config.decode('utf-8') if isinstance(model_config, bytes) else model_config)
+        weights_group = model_file['model_weights'] if 'model_weights' in model_file else model_file
+
+        layer_configs = model_config['config']
+        if isinstance(layer_configs, dict):
+            layer_configs = layer_configs['layers']
+
+        input_shape = None
+        layer_specs = []
+        for layer_config in layer_configs:
+            class_name, config = layer_config['class_name'], layer_config['config']
+            batch_input_shape = config.get('batch_input_shape') or config.get('batch_shape')
+            if input_shape is None and batch_input_shape is not None:
+                input_shape = tuple(batch_input_shape[1:])
+            if class_name == 'InputLayer':
+                continue
+
+            weights = []
+            if config['name'] in weights_group:
+                layer_group = weights_group[config['name']]
+                for weight_name in layer_group.attrs['weight_names']:
+                    weight_name = weight_name.decode('utf-8') if isinstance(weight_name, bytes) else weight_name
+                    weights.append(np.array(layer_group[weight_name]))
+            layer_specs.append((class_name, config, weights))
+
+    return input_shape, layer_specs
+
+
+# The same specs, taken from a loaded Keras model
+def read_keras_model(model):
+    layer_specs = [(type(layer).__name__, layer.get_config(), layer.get_weights()) for layer in model.layers]
+    return tuple(model.input_shape[1:]), layer_specs
+
+
+def convert(input_shape, layer_specs):
+    height, width, channels = input_shape
+    shape = (channels, height, width)  # the shape of the current layer's input, in NCHW
+    flattened_shape = None  # the (C, H, W) shape that the last Flatten layer flattened
+    network = []
+
+    for class_name, config, weights in layer_specs:
+        if class_name == 'Conv2D':
+            check_supported(config, class_name, dilation_rate=(1, 1), data_format='channels_last')
+            kernel, bias = weights
+            kernel_height, kernel_width, _, filters_amount = kernel.shape
+            # Keras' 'same' padding puts the extra zero at the bottom and right too
+            layer = Convolutional(shape, kernel_height, kernel_width, filters_amount, initialize=False,
+                                  stride=tuple(config.get('strides', (1, 1))), padding=config.get('padding', 'valid'))
+            # (kh, kw, in, out) -> (out, in, kh, kw), Keras' Conv2D is a cross-correlation too
+            layer.filters[...] = kernel.transpose(3, 2, 0, 1)
+            # Keras shares one bias per filter, this library has one per output position
+            layer.biases[...] = bias[:, np.newaxis, np.newaxis]
+            network.append(layer)
+            shape = layer.output_shape
+            append_activation(network, config)
+
+        elif class_name == 'MaxPooling2D':
+            pool_size = tuple(config['pool_size'])
+            check_supported(config, class_name, padding='valid', strides=pool_size, data_format='channels_last')
+            network.append(MaxPooling(pool_size))
+            shape = (shape[0], shape[1] // pool_size[0], shape[2] // pool_size[1])
+
+        elif class_name == 'Dropout':
+            network.append(Dropout(config['rate']))
+
+        elif class_name == 'Flatten':
+            network.append(Flatten(shape))
+            flattened_shape = shape
+            shape = (int(np.prod(shape)),)
+
+        elif class_name == 'Dense':
+            kernel, bias = weights
+            input_size, output_size = kernel.shape
+            if flattened_shape is not None:
+                # Keras flattened (H, W, C) while this library flattens (C, H, W), so the kernel's rows are reordered
+                depth, flat_height, flat_width = flattened_shape
+                kernel = kernel.reshape(flat_height, flat_width, depth, output_size).transpose(2, 0, 1, 3).reshape(input_size, output_size)
+                flattened_shape = None
+            layer = Dense(input_size, output_size, initialize=False)
+            layer.weights[...] = kernel.T
+            layer.bias[...] = bias[:, np.newaxis]
+            network.append(layer)
+            shape = (output_size,)
+            append_activation(network, config)
+
+        else:
+            raise ValueError(f'Keras layer {class_name} is not supported')
+
+    return network
+
+
+def check_supported(config, class_name, **expected):
+    for key, value in expected.items():
+        actual = config.get(key, value)
+        if (tuple(actual) if isinstance(actual, list) else actual) != value:
+            raise ValueError(f'{class_name} with {key}={actual} is not supported, only {key}={value}')
+
+
+def append_activation(network, config):
+    activation = config.get('activation', 'linear')
+    if activation not in ACTIVATIONS:
+        raise ValueError(f'Activation {activation} is not supported')
+    if ACTIVATIONS[activation] is not None:
+        network.append(ACTIVATIONS[activation]())
+
+
+def convert_h5(h5_path):
+    return convert(*read_h5(h5_path))
+
+
+def main():
+    h5_path, model_path = sys.argv[1:3]
+    network = convert_h5(h5_path)
+    save(network, model_path)
+    print(f'Converted {h5_path} into {model_path} ({len(network)} layers)')
+
+
+if __name__ == '__main__':
+    main()
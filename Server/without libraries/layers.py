@@ -1,106 +1,218 @@
 import numpy as np
-from scipy import signal
+from numpy.lib.stride_tricks import as_strided
+from convolution import get_backend, correlation_shape
+from dtypes import get_default_dtype
+from workspace import Workspace
 
 
 # Base Layer
-class Layer:
+# Every layer works on batches, the first axis of its input and output is the sample axis
+# Outputs and gradients are written into buffers that are reused while the input shape stays the same (see Workspace),
+# so a layer's returned arrays are only valid until its next forward/backward call
+# forward runs in inference mode when train is False, it then keeps nothing around for backward
+class Layer(Workspace):
+    parameter_names = ()  # the names of the layer's learnable parameters attributes
+    cache_names = ('input', 'output')  # the names of the attributes forward keeps for backward
+
     def __int__(self):
         self.input = None
         self.output = None
 
-    def forward(self, input):
+    def forward(self, input, train=True):
         # Returns output
         pass
 
     def backward(self, output_gradient, learning_rate):
-        # Updates the layer's learnable parameters
+        # Writes the gradients of the layer's learnable parameters and updates them (see update)
         # Returns input gradient
         pass
 
+    def gradient(self, name):
+        # the array backward writes the gradient of the named parameter into
+        # an optimizer may bind it to a view of its own flat gradient buffer
+        gradients = self.__dict__.setdefault('gradients', {})
+        if name not in gradients:
+            gradients[name] = np.zeros_like(getattr(self, name))
+        return gradients[name]
+
+    def update(self, learning_rate):
+        # a plain SGD step, when an optimizer applies the updates the layers are given no learning rate
+        if learning_rate is None:
+            return
+        for name in self.parameter_names:
+            # the gradient is scaled in place, so the update doesn't allocate temporaries
+            gradient = self.gradient(name)
+            gradient *= learning_rate
+            parameter = getattr(self, name)
+            parameter -= gradient
+
+    def get_config(self):
+        # the constructor arguments that rebuild the layer (see serialization.py)
+        return {}
+
+    def free_caches(self):
+        # drops everything the training passes left on the layer, the parameters are kept
+        for name in self.cache_names:
+            setattr(self, name, None)
+        self.free_buffers()
+
 
 # Convolutional Layer
 class Convolutional(Layer):
-    def __init__(self, input_shape, kernel_height, kernel_width, filters_amount):
+    parameter_names = ('filters', 'biases')
+
+    # initialize=False leaves the parameters uninitialized, for layers whose parameters are loaded right after
+    # stride is an int or a (rows, columns) pair, a stride of 2 computes a quarter of the outputs instead of pooling them
+    # padding is 'valid' (none), 'same' (the output is input size / stride, rounded up, the extra zero is put at the
+    # bottom and right like Keras does), an int, a (rows, columns) pair or ((top, bottom), (left, right))
+    def __init__(self, input_shape, kernel_height, kernel_width, filters_amount, backend='im2col', initialize=True,
+                 stride=1, padding='valid'):
         input_depth, input_height, input_width = input_shape
         self.filters_amount = filters_amount
         self.kernels_per_filter = input_depth  # the amount of kernels in each filter is equal to channels amount in input image
         self.input_shape = input_shape
-        self.output_shape = (filters_amount, input_height - kernel_height + 1, input_width - kernel_width + 1)
+        self.stride = (stride, stride) if isinstance(stride, int) else tuple(stride)
+        self.padding = resolve_padding(padding, input_shape[1:], (kernel_height, kernel_width), self.stride)
+        (top, bottom), (left, right) = self.padding
+        self.padded_shape = (input_depth, input_height + top + bottom, input_width + left + right)
+        self.output_shape = (filters_amount, *correlation_shape(*self.padded_shape[1:], kernel_height, kernel_width, self.stride))
         self.filters_shape = (filters_amount, self.kernels_per_filter, kernel_height, kernel_width)
-        self.filters = np.random.randn(*self.filters_shape)  # * is used to unpack the tuple
-        self.biases = np.random.randn(*self.output_shape)
-
-    def forward(self, input):
-        self.input = input
-        self.output = np.copy(self.biases)
+        self.dtype = get_default_dtype()
+        if initialize:
+            self.filters = np.random.randn(*self.filters_shape).astype(self.dtype)  # * is used to unpack the tuple
+            self.biases = np.random.randn(*self.output_shape).astype(self.dtype)
+        else:
+            self.filters = np.empty(self.filters_shape, dtype=self.dtype)
+            self.biases = np.empty(self.output_shape, dtype=self.dtype)
+        self.backend_name = backend
+        self.backend = get_backend(backend)  # 'im2col', 'fft', 'auto' (fastest of the two) or 'direct' (scipy reference)
 
-        for filter_index in range(self.filters_amount):
-            for kernel_index in range(self.kernels_per_filter):
-                self.output[filter_index] += \
-                    signal.correlate2d(self.input[kernel_index], self.filters[filter_index, kernel_index], 'valid')
+    def get_config(self):
+        return {'input_shape': self.input_shape, 'kernel_height': self.filters_shape[2], 'kernel_width': self.filters_shape[3],
+                'filters_amount': self.filters_amount, 'backend': self.backend_name, 'stride': self.stride,
+                'padding': self.padding}
 
-        return self.output
+    def forward(self, input, train=True):
+        input = self.pad(input, train)
+        output = self.backend.forward(input, self.filters, self.biases, self.stride, train)
+        if train:
+            self.input, self.output = input, output
+        return output
 
     def backward(self, output_gradient, learning_rate):
-        # Cross-Correlation (★) is sliding a kernel across an image
-        # Convolution (∗) is sliding a flipped (180° rotated) kernel across an image
-        # i is the index of the filter, j is the index of the kernel within the filter
-        filters_gradient = np.zeros(self.filters_shape)  # dE/dF[i][j] = X[j] ★ (dE/dY[i])
-        biases_gradient = output_gradient  # dE/dB[i] = dE/dY[i]
-        input_gradient = np.zeros(self.input_shape)  # dE/dX[j] = Σ(i=1, i<filters amount)->(dE/dY[i] ∗full F[i][j])
-
-        for filter_index in range(self.filters_amount):
-            for kernel_index in range(self.kernels_per_filter):
-                filters_gradient[filter_index, kernel_index] = \
-                    signal.correlate2d(self.input[kernel_index], output_gradient[filter_index], 'valid')
-                input_gradient[kernel_index] += \
-                    signal.convolve2d(output_gradient[filter_index], self.filters[filter_index, kernel_index], 'full')
-
-        self.filters -= learning_rate * filters_gradient
-        self.biases -= learning_rate * biases_gradient
-        return input_gradient
+        input_gradient = self.backend.backward(self.input, self.filters, output_gradient, self.gradient('filters'), self.stride)
+        np.sum(output_gradient, axis=0, out=self.gradient('biases'))  # dE/dB[i] = dE/dY[i], summed over the batch
+        self.update(learning_rate)
+        # the gradient of the padding is dropped
+        (top, bottom), (left, right) = self.padding
+        return input_gradient[:, :, top: input_gradient.shape[2] - bottom, left: input_gradient.shape[3] - right]
+
+    def pad(self, input, train=True):
+        if self.padded_shape == self.input_shape:
+            return input
+        # only the inside of the padded buffer is ever written, so its border stays 0
+        # an inference forward pads into a buffer of its own, the training one is the input backward reads
+        (top, bottom), (left, right) = self.padding
+        padded_input = self.buffer('padded_input' if train else 'inference_padded_input',
+                                   (len(input), *self.padded_shape), input.dtype)
+        padded_input[:, :, top: top + input.shape[2], left: left + input.shape[3]] = input
+        return padded_input
+
+    def free_caches(self):
+        super().free_caches()
+        self.backend.free_buffers()
+
+
+# The ((top, bottom), (left, right)) zero padding of a Convolutional layer's padding argument
+def resolve_padding(padding, input_size, kernel_size, stride):
+    if padding == 'valid':
+        return (0, 0), (0, 0)
+    if padding == 'same':
+        sides = []
+        for size, kernel, step in zip(input_size, kernel_size, stride):
+            total = max((-(-size // step) - 1) * step + kernel - size, 0)
+            sides.append((total // 2, total - total // 2))
+        return tuple(sides)
+    if isinstance(padding, int):
+        return (padding, padding), (padding, padding)
+    return tuple((side, side) if isinstance(side, int) else tuple(side) for side in padding)
 
 
 # Dense Layer
 class Dense(Layer):
-    def __init__(self, input_size, output_size):
-        self.weights = np.random.randn(output_size, input_size)
-        self.bias = np.random.randn(output_size, 1)
+    parameter_names = ('weights', 'bias')
+
+    # initialize=False leaves the parameters uninitialized, for layers whose parameters are loaded right after
+    def __init__(self, input_size, output_size, initialize=True):
+        self.dtype = get_default_dtype()
+        if initialize:
+            self.weights = np.random.randn(output_size, input_size).astype(self.dtype)
+            self.bias = np.random.randn(output_size, 1).astype(self.dtype)
+        else:
+            self.weights = np.empty((output_size, input_size), dtype=self.dtype)
+            self.bias = np.empty((output_size, 1), dtype=self.dtype)
 
-    def forward(self, input):
-        self.input = input
-        self.output = np.dot(self.weights, self.input) + self.bias  # Y = W · X + B
-        return self.output
+    def get_config(self):
+        output_size, input_size = self.weights.shape
+        return {'input_size': input_size, 'output_size': output_size}
+
+    def forward(self, input, train=True):
+        # the input is a batch of (n, 1) column vectors, which is multiplied as a single (N, n) matrix
+        output = self.buffer('output', (len(input), len(self.weights)), self.dtype)
+        np.dot(input[..., 0], self.weights.T, out=output)
+        output = output[..., np.newaxis]
+        output += self.bias  # Y = W · X + B
+        if train:
+            self.input, self.output = input, output
+        return output
 
     def backward(self, output_gradient, learning_rate):
-        weights_gradient = np.dot(output_gradient, self.input.T)  # dE/dW = dE/dY · transposed(X)
-        bias_gradient = output_gradient  # dE/dB = dE/dY
-        input_gradient = np.dot(self.weights.T, output_gradient)  # dE/dX = transposed(W) · dE/dY
-        self.weights -= learning_rate * weights_gradient
-        self.bias -= learning_rate * bias_gradient
-        return input_gradient
+        flat_output_gradient = output_gradient[..., 0]
+        input_gradient = self.buffer('input_gradient', self.input.shape[: 2], self.dtype)
+
+        # the products below also sum the parameter gradients over the batch
+        np.dot(flat_output_gradient.T, self.input[..., 0], out=self.gradient('weights'))  # dE/dW = dE/dY · transposed(X)
+        np.sum(output_gradient, axis=0, out=self.gradient('bias'))  # dE/dB = dE/dY
+        np.dot(flat_output_gradient, self.weights, out=input_gradient)  # dE/dX = transposed(W) · dE/dY
+
+        self.update(learning_rate)
+        return input_gradient[..., np.newaxis]
 
 
 # Dropout Layer
 class Dropout(Layer):
+    cache_names = Layer.cache_names + ('mask',)
+
     def __init__(self, drop_rate):
         self.drop_rate = drop_rate
-        self.mask = None
+        self.mask = None  # a boolean mask, True for every kept value
+        # the generator is seeded from numpy's global random state, so np.random.seed still makes runs repeatable
+        self.generator = np.random.default_rng(np.random.randint(2 ** 31))
+
+    def get_config(self):
+        return {'drop_rate': self.drop_rate}
 
     def forward(self, input, train=True):
+        # nothing is dropped in inference, so the input passes through untouched
+        if not train:
+            return input
+
         self.input = input
+        self.output = self.buffer('output', input.shape, input.dtype)
+        self.mask = self.buffer('mask', input.shape, bool)
 
-        if train:
-            self.mask = np.random.binomial(1, 1 - self.drop_rate, input.shape)
-        else:
-            self.mask = np.ones(input.shape)
+        # every value is kept with a probability of (1 - drop rate)
+        uniform = self.buffer('uniform', input.shape, np.float32)
+        self.generator.random(dtype=np.float32, out=uniform)
+        np.greater_equal(uniform, self.drop_rate, out=self.mask)
 
-        self.output = self.input * self.mask
+        np.multiply(self.input, self.mask, out=self.output)
         return self.output
 
     def backward(self, output_gradient, learning_rate):
         # dY/dX = mask
-        input_gradient = output_gradient * self.mask  # dE/dX = dE/dY * dY/dX
+        input_gradient = self.buffer('input_gradient', output_gradient.shape, output_gradient.dtype)
+        np.multiply(output_gradient, self.mask, out=input_gradient)  # dE/dX = dE/dY * dY/dX
         return input_gradient
 
 
@@ -110,13 +222,17 @@ class Flatten(Layer):
         self.input_shape = input_shape
         self.output_shape = (-1, 1)
 
-    def forward(self, input):
-        self.input = input
-        self.output = np.reshape(self.input, self.output_shape)
-        return self.output
+    def get_config(self):
+        return {'input_shape': self.input_shape}
+
+    def forward(self, input, train=True):
+        output = np.reshape(input, (len(input), *self.output_shape))
+        if train:
+            self.input, self.output = input, output
+        return output
 
     def backward(self, output_gradient, learning_rate):
-        input_gradient = np.reshape(output_gradient, self.input_shape)
+        input_gradient = np.reshape(output_gradient, (len(output_gradient), *self.input_shape))
         return input_gradient
 
 
@@ -126,59 +242,88 @@ class Reshape(Layer):
         self.input_shape = input_shape
         self.output_shape = output_shape
 
-    def forward(self, input):
-        self.input = input
-        self.output = np.reshape(self.input, self.output_shape)
-        return self.output
+    def get_config(self):
+        return {'input_shape': self.input_shape, 'output_shape': self.output_shape}
+
+    def forward(self, input, train=True):
+        output = np.reshape(input, (len(input), *self.output_shape))
+        if train:
+            self.input, self.output = input, output
+        return output
 
     def backward(self, output_gradient, learning_rate):
-        input_gradient = np.reshape(output_gradient, self.input_shape)
+        input_gradient = np.reshape(output_gradient, (len(output_gradient), *self.input_shape))
         return input_gradient
 
 
 # MaxPooling Layer
 class MaxPooling(Layer):
+    cache_names = Layer.cache_names + ('selections',)
+
     def __init__(self, pool_size=(2, 2)):
         self.pool_size = pool_size
-        self.selections = None  # contains 1 in the location of max value in each patch and 0 in the rest
+        self.selections = None  # the index of the max value inside each patch (in relation to the flattened patch)
 
-    def forward(self, input):
-        self.input = input
-        self.selections = np.zeros_like(self.input)
+    def get_config(self):
+        return {'pool_size': self.pool_size}
+
+    def forward(self, input, train=True):
         patch_height, patch_width = self.pool_size  # the dimensions of the applied patch
-        input_depth, input_height, input_width = self.input.shape  # the dimensions of the input
-        output_shape = (input_depth, input_height // patch_height, input_width // patch_width)
-        self.output = np.empty(output_shape)
-
-        # iterating over every patch in the input in channel-row-col order
-        for channel in range(input_depth):
-            for i, row in enumerate(range(0, input_height - input_height % patch_height, patch_height)):
-                for j, col in enumerate(range(0, input_width - input_width % patch_width, patch_width)):
-                    # get the values of the patch
-                    patch = self.input[channel, row: row + patch_height, col: col + patch_width]
-                    # find the location of the patch's max value (in relation to the patch)
-                    max_row, max_col = np.argmax(patch) // patch_width, np.argmax(patch) % patch_width
-                    # find the location of the patch's max value (in relation to the input matrix)
-                    max_row, max_col = row + max_row, col + max_col
-                    # set the location of the patch's max value to 1 in the selections matrix
-                    self.selections[channel, max_row, max_col] = 1
-                    # add the patch's max value to the output matrix
-                    self.output[channel, i, j] = np.max(patch)
+        batch_size, input_depth, input_height, input_width = input.shape  # the dimensions of the input
+        # rows and columns that don't fill a whole patch are dropped
+        output_height, output_width = input_height // patch_height, input_width // patch_width
+        batch_stride, depth_stride, row_stride, col_stride = input.strides
+
+        # a strided view of every patch in the input, no data is copied
+        patches = as_strided(input,
+                             shape=(batch_size, input_depth, output_height, output_width, patch_height, patch_width),
+                             strides=(batch_stride, depth_stride, row_stride * patch_height, col_stride * patch_width,
+                                      row_stride, col_stride),
+                             writeable=False)
+
+        # inference only needs the max values, which are reduced pairwise over the offsets inside the patch,
+        # straight from the input and without copying the patches
+        if not train:
+            output = self.buffer('output', (batch_size, input_depth, output_height, output_width), input.dtype)
+            np.copyto(output, patches[..., 0, 0])
+            for row in range(patch_height):
+                for col in range(patch_width):
+                    np.maximum(output, patches[..., row, col], out=output)
+            return output
 
+        self.input = input
+        # the patches are copied once into a buffer where each one is a contiguous row
+        patches_shape = (batch_size, input_depth, output_height, output_width, patch_height * patch_width)
+        flat_patches = self.buffer('patches', patches_shape, input.dtype)
+        np.copyto(flat_patches.reshape(patches.shape), patches)
+
+        # find the location and the value of every patch's max
+        selections = self.buffer('selections', patches_shape[: -1], np.intp)
+        self.output = self.buffer('output', patches_shape[: -1], input.dtype)
+        np.argmax(flat_patches, axis=-1, out=selections)
+        np.max(flat_patches, axis=-1, out=self.output)
+        self.selections = selections[..., np.newaxis]
         return self.output
 
     def backward(self, output_gradient, learning_rate):
-        input_gradient = np.zeros_like(self.input)
-        input_gradient_depth, input_gradient_height, input_gradient_width = input_gradient.shape
         patch_height, patch_width = self.pool_size  # the dimensions of the patch
-
-        # iterating over every patch in the input gradient in channel-row-col order
-        for channel in range(input_gradient_depth):
-            for i, row in enumerate(range(0, input_gradient_height - input_gradient_height % patch_height, patch_height)):
-                for j, col in enumerate(range(0, input_gradient_width - input_gradient_width % patch_width, patch_width)):
-                    # each patch in the input gradient is set to be the multiplication between the matching patch of the selections matrix and output gradient's value for that patch
-                    input_gradient[channel, row: row + patch_height, col: col + patch_width] = \
-                        self.selections[channel, row: row + patch_height, col: col + patch_width] * \
-                        output_gradient[channel, i, j]
-
+        batch_size, input_depth, output_height, output_width = output_gradient.shape
+
+        # route every output gradient value to the location of its patch's max value, the rest of the patch is 0
+        # the gradient is built one offset inside the patch at a time, as (offset == selection) * dE/dY, into a buffer
+        # with the offset as its first axis, so every write is contiguous and no index arrays are built
+        patches_gradient = self.buffer('patches_gradient',
+                                       (patch_height * patch_width, batch_size, input_depth, output_height, output_width),
+                                       output_gradient.dtype)
+        for offset, offset_gradient in enumerate(patches_gradient):
+            np.equal(self.selections[..., 0], offset, out=offset_gradient, casting='unsafe')
+            offset_gradient *= output_gradient
+
+        # reorder the patches back into the spatial layout of the input
+        # rows and columns that were dropped in the forward pass are never written, so they keep a gradient of 0
+        patches_gradient = patches_gradient.reshape(patch_height, patch_width, batch_size, input_depth, output_height, output_width)
+        input_gradient = self.buffer('input_gradient', self.input.shape, output_gradient.dtype)
+        pooled_area = input_gradient[:, :, : output_height * patch_height, : output_width * patch_width]
+        np.copyto(pooled_area.reshape(batch_size, input_depth, output_height, patch_height, output_width, patch_width),
+                  patches_gradient.transpose(2, 3, 4, 0, 5, 1))
         return input_gradient
@@ -0,0 +1,99 @@
+import numpy as np
+import threading
+import queue
+from dtypes import get_default_dtype
+
+
+# Streams (x, y) batches out of arrays that don't have to fit in memory, typically memory maps of uint8 images:
+#   Loader(np.load('x.npy', mmap_mode='r'), np.load('y.npy'), scale=1 / 255)
+# Only a batch is ever read, converted to the network's dtype and scaled at a time, so the float copy of the whole
+# dataset is never created. The batches are read by a background thread, prefetch batches ahead of the training loop,
+# and numpy releases the GIL while it converts them, so reading the next batch overlaps with training on this one
+# len(loader) is the number of samples, like len(x_train), and network.train accepts a Loader in place of x_train
+class Loader:
+    def __init__(self, x, y, scale=None, shuffle=True, channels_last=False, prefetch=2, seed=None, indices=None):
+        self.x = x
+        self.y = y
+        self.scale = scale  # e.g. 1 / 255, multiplies every batch after its conversion
+        self.shuffle = shuffle  # a new permutation of the samples every epoch
+        self.channels_last = channels_last  # x is (N, H, W, C) and its batches are transposed to (N, C, H, W)
+        self.prefetch = prefetch  # how many batches are read ahead, 0 reads them in the training loop's thread
+        self.generator = np.random.default_rng(seed)
+        self.indices = np.arange(len(x)) if indices is None else indices  # the samples of x this loader streams
+
+    def __len__(self):
+        return len(self.indices)
+
+    # Splits the samples into a loader of the first fraction of them and a loader of the rest, which isn't shuffled
+    # (the validation set, like network.train's val_split), both read the same arrays
+    def split(self, fraction):
+        split_index = int(fraction * len(self))
+        first = Loader(self.x, self.y, self.scale, self.shuffle, self.channels_last, self.prefetch,
+                       indices=self.indices[: split_index])
+        first.generator = self.generator
+        rest = Loader(self.x, self.y, self.scale, False, self.channels_last, self.prefetch,
+                      indices=self.indices[split_index:])
+        return first, rest
+
+    def read(self, indices, dtype):
+        # sorted indices read the memory map front to back, the order within a batch doesn't change its gradient
+        indices = np.sort(indices)
+        x = self.x[indices]
+        if self.channels_last:
+            x = x.transpose(0, 3, 1, 2)
+
+        # a single conversion pass into a contiguous batch of the network's dtype
+        batch = np.empty(x.shape, dtype=dtype)
+        if self.scale is None:
+            np.copyto(batch, x, casting='unsafe')
+        else:
+            np.multiply(x, self.scale, out=batch, casting='unsafe')
+        return batch, np.asarray(self.y[indices])
+
+    # Yields the epoch's (x, y) batches
+    def batches(self, batch_size, dtype=None):
+        dtype = get_default_dtype() if dtype is None else np.dtype(dtype)
+        order = self.generator.permutation(self.indices) if self.shuffle else self.indices
+        batch_indices = [order[start: start + batch_size] for start in range(0, len(order), batch_size)]
+
+        if not self.prefetch:
+            for indices in batch_indices:
+                yield self.read(indices, dtype)
+            return
+
+        batches = queue.Queue(maxsize=self.prefetch)
+        stopped = threading.Event()
+
+        def put(item):
+            # gives up when the training loop stopped consuming the batches (e.g. it raised)
+            while not stopped.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read_batches():
+            try:
+                for indices in batch_indices:
+                    if not put(self.read(indices, dtype)):
+                        return
+                put(None)
+            except Exception as exception:
+                # the error is raised again in the training loop's thread
+                put(exception)
+
+        reader = threading.Thread(target=read_batches, daemon=True)
+        reader.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stopped.set()
+            reader.join()
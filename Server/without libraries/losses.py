@@ -1,81 +1,217 @@
 import numpy as np
 
 
+# Every loss receives a batch, the first axis of y_true and y_pred is the sample axis
+# The loss is the mean of the samples' losses and the gradient is divided by the batch size accordingly,
+# so the layers' parameter gradients (summed over the batch) end up averaged over the batch
+# y_true is either shaped like y_pred or a vector of integer class labels, which are used as indices into y_pred
+# (gathers), so no one hot encoded array is ever created
+# Every loss also has an _and_prime function that returns the loss and its gradient from a single pass,
+# sharing the logarithms, divisions and gathers both need (see network.train's loss_and_prime)
+
+
+# 10^-100 underflows to 0 in float32, so the epsilon is never smaller than the tiniest normal number of y_pred's dtype
+def safe_epsilon(y_pred):
+    return max(10 ** -100, float(np.finfo(y_pred.dtype).tiny))
+
+
+# Whether y_true is a vector of integer class labels rather than an array shaped like y_pred
+def is_labels(y_true, y_pred):
+    return y_true.ndim < y_pred.ndim and np.issubdtype(y_true.dtype, np.integer)
+
+
+# The indices of every sample's label, y_pred[label_indices(y_true)] gathers Y_pred[i][Y_true[i]] for every sample i
+def label_indices(y_true):
+    return np.arange(len(y_true)), y_true
+
+
 # Mean Squared Error (MSE) loss function and its derivative
 class MeanSquaredError:
+    @staticmethod
+    def difference(y_true, y_pred):
+        # Y_pred - Y_true, with labels the 1 is only subtracted at the label's index
+        if is_labels(y_true, y_pred):
+            difference = np.copy(y_pred)
+            difference[label_indices(y_true)] -= 1
+            return difference
+        return y_pred - y_true
+
     @staticmethod
     def mean_squared_error(y_true, y_pred):
         # E = (1 / n) * Σ(Y_pred[i] - Y_true[i])^2
-        E = np.mean(np.power(y_true - y_pred, 2))
+        E = np.mean(np.square(MeanSquaredError.difference(y_true, y_pred)))
         return E
 
     @staticmethod
     def mean_squared_error_prime(y_true, y_pred):
         # dE/dY_pred = (2 / n) * (Y_pred - Y_true)
-        output_gradient = 2 * (y_pred - y_true) / np.size(y_true)
+        output_gradient = MeanSquaredError.difference(y_true, y_pred)
+        output_gradient *= 2 / np.size(y_pred)
         return output_gradient
 
+    @staticmethod
+    def mean_squared_error_and_prime(y_true, y_pred):
+        output_gradient = MeanSquaredError.difference(y_true, y_pred)
+        E = np.mean(np.square(output_gradient))
+        output_gradient *= 2 / np.size(y_pred)
+        return E, output_gradient
+
 
 # Binary Cross Entropy loss function and its derivative
+# With labels, Y_true is 1 at every sample's label and 0 everywhere else
 class BinaryCrossEntropy:
     @staticmethod
     def binary_cross_entropy(y_true, y_pred):
         # prevent a possible log(0) and divisions by 0
-        epsilon = 10 ** -100
+        epsilon = safe_epsilon(y_pred)
+        if is_labels(y_true, y_pred):
+            # log(1 - Y_pred[i]) everywhere but at the labels, where it's log(Y_pred[i])
+            log_likelihoods = np.log(1 - y_pred + epsilon)
+            indices = label_indices(y_true)
+            log_likelihoods[indices] = np.log(y_pred[indices] + epsilon)
+            return -np.mean(log_likelihoods)
         # E = (-1 / n) * Σ(Y_true[i] * log(Y_pred[i]) + (1 - Y_true[i]) * log(1 - Y_pred[i]))
         E = -np.mean(y_true * np.log(y_pred + epsilon) + (1 - y_true) * np.log(1 - y_pred + epsilon))
         return E
 
     @staticmethod
     def binary_cross_entropy_prime(y_true, y_pred):
+        return BinaryCrossEntropy.binary_cross_entropy_and_prime(y_true, y_pred, compute_loss=False)[1]
+
+    @staticmethod
+    def binary_cross_entropy_and_prime(y_true, y_pred, compute_loss=True):
         # prevent a possible log(0) and divisions by 0
-        epsilon = 10 ** -100
+        epsilon = safe_epsilon(y_pred)
+        E = None
+        if is_labels(y_true, y_pred):
+            indices = label_indices(y_true)
+            complements = 1 - y_pred + epsilon
+            predictions = y_pred[indices] + epsilon
+            if compute_loss:
+                log_likelihoods = np.log(complements)
+                log_likelihoods[indices] = np.log(predictions)
+                E = -np.mean(log_likelihoods)
+            # dE/dY_pred = (1 / n) * 1 / (1 - Y_pred) everywhere but at the labels, where it's (1 / n) * -1 / Y_pred
+            output_gradient = np.reciprocal(complements, out=complements)
+            output_gradient[indices] = -1 / predictions
+            output_gradient /= np.size(y_pred)
+            return E, output_gradient
+
+        predictions = y_pred + epsilon
+        complements = 1 - y_pred + epsilon
+        if compute_loss:
+            E = -np.mean(y_true * np.log(predictions) + (1 - y_true) * np.log(complements))
         # dE/dY_pred = (1 / n) * ((1 - Y_true) / (1 - Y_pred) - Y_true / Y_pred)
-        output_gradient = ((1 - y_true) / (1 - y_pred + epsilon) - y_true / (y_pred + epsilon)) / np.size(y_true)
-        return output_gradient
+        output_gradient = ((1 - y_true) / complements - y_true / predictions) / np.size(y_pred)
+        return E, output_gradient
 
 
 # Categorical Cross Entropy loss function and its derivative
 class CategoricalCrossEntropy:
     @staticmethod
     def categorical_cross_entropy(y_true, y_pred):
+        if is_labels(y_true, y_pred):
+            return SparseCategoricalCrossEntropy.sparse_categorical_cross_entropy(y_true, y_pred)
         # prevent a possible log(0)
-        epsilon = 10 ** -100
+        epsilon = safe_epsilon(y_pred)
         # E = -Σ(Y_true[i] * log(Y_pred[i]))
-        E = -np.sum(y_true * np.log(y_pred + epsilon))
+        E = -np.sum(y_true * np.log(y_pred + epsilon)) / len(y_true)
         return E
 
     @staticmethod
     def categorical_cross_entropy_prime(y_true, y_pred):
+        if is_labels(y_true, y_pred):
+            return SparseCategoricalCrossEntropy.sparse_categorical_cross_entropy_prime(y_true, y_pred)
         # prevent a possible division by 0
-        epsilon = 10 ** -100
+        epsilon = safe_epsilon(y_pred)
         # dE/dY_pred = -Y_true / Y_pred
-        output_gradient = -y_true / (y_pred + epsilon)
+        output_gradient = -y_true / (y_pred + epsilon) / len(y_true)
         return output_gradient
 
+    @staticmethod
+    def categorical_cross_entropy_and_prime(y_true, y_pred):
+        if is_labels(y_true, y_pred):
+            return SparseCategoricalCrossEntropy.sparse_categorical_cross_entropy_and_prime(y_true, y_pred)
+        predictions = y_pred + safe_epsilon(y_pred)
+        E = -np.sum(y_true * np.log(predictions)) / len(y_true)
+        output_gradient = -y_true / predictions / len(y_true)
+        return E, output_gradient
+
 
 # Sparse Categorical Cross Entropy loss function and its derivative
+# y_true holds integer labels, only every sample's prediction for its label is gathered
 class SparseCategoricalCrossEntropy:
     @staticmethod
     def sparse_categorical_cross_entropy(y_true, y_pred):
-        # create a one hot encoded vector from the integer y_true
-        one_hot_encoded = np.zeros_like(y_pred)
-        one_hot_encoded[y_true] = 1
         # prevent a possible log(0)
-        epsilon = 10 ** -100
-        # E = -Σ(one_hot_encoded[i] * log(Y_pred[i]))
-        E = -np.sum(one_hot_encoded * np.log(y_pred + epsilon))
-        # E = -np.log(y_pred[y_true] + epsilon)
+        epsilon = safe_epsilon(y_pred)
+        # E = -log(Y_pred[Y_true])
+        E = -np.mean(np.log(y_pred[label_indices(y_true)] + epsilon))
         return E
 
     @staticmethod
     def sparse_categorical_cross_entropy_prime(y_true, y_pred):
-        # create a one hot encoded vector from the integer y_true
-        one_hot_encoded = np.zeros_like(y_pred)
-        one_hot_encoded[y_true] = 1
-        # prevent a possible division by 0
-        epsilon = 10 ** -100
-        # dE/dY_pred = -one_hot_encoded / Y_pred
-        output_gradient = -one_hot_encoded / (y_pred + epsilon)
-        # output_gradient = -1 / (y_pred[y_true] + epsilon)
+        return SparseCategoricalCrossEntropy.sparse_categorical_cross_entropy_and_prime(y_true, y_pred,
+                                                                                         compute_loss=False)[1]
+
+    @staticmethod
+    def sparse_categorical_cross_entropy_and_prime(y_true, y_pred, compute_loss=True):
+        indices = label_indices(y_true)
+        # prevent a possible log(0) and division by 0
+        predictions = y_pred[indices] + safe_epsilon(y_pred)
+        E = -np.mean(np.log(predictions)) if compute_loss else None
+        # dE/dY_pred = -1 / Y_pred at the label's index, 0 everywhere else
+        output_gradient = np.zeros_like(y_pred)
+        output_gradient[indices] = -1 / predictions / len(y_true)
+        return E, output_gradient
+
+
+# Softmax + Categorical Cross Entropy fused into one loss, to be used after an activations.FusedSoftmax layer
+# The prime is the gradient with respect to the softmax's input, which is just Y_pred - Y_true,
+# so neither the softmax's jacobian nor a division by Y_pred is needed
+class SoftmaxCrossEntropy:
+    @staticmethod
+    def softmax_cross_entropy(y_true, y_pred):
+        return CategoricalCrossEntropy.categorical_cross_entropy(y_true, y_pred)
+
+    @staticmethod
+    def softmax_cross_entropy_prime(y_true, y_pred):
+        if is_labels(y_true, y_pred):
+            return SparseSoftmaxCrossEntropy.sparse_softmax_cross_entropy_prime(y_true, y_pred)
+        # dE/dX = Y_pred - Y_true
+        output_gradient = (y_pred - y_true) / len(y_true)
+        return output_gradient
+
+    @staticmethod
+    def softmax_cross_entropy_and_prime(y_true, y_pred):
+        if is_labels(y_true, y_pred):
+            return SparseSoftmaxCrossEntropy.sparse_softmax_cross_entropy_and_prime(y_true, y_pred)
+        return (SoftmaxCrossEntropy.softmax_cross_entropy(y_true, y_pred),
+                SoftmaxCrossEntropy.softmax_cross_entropy_prime(y_true, y_pred))
+
+
+# Softmax + Sparse Categorical Cross Entropy fused into one loss, to be used after an activations.FusedSoftmax layer
+# The integer labels are used as indices, no one hot encoded vector is created
+class SparseSoftmaxCrossEntropy:
+    @staticmethod
+    def sparse_softmax_cross_entropy(y_true, y_pred):
+        return SparseCategoricalCrossEntropy.sparse_categorical_cross_entropy(y_true, y_pred)
+
+    @staticmethod
+    def sparse_softmax_cross_entropy_prime(y_true, y_pred):
+        # dE/dX = Y_pred - one_hot_encoded, the 1 is only subtracted at the label's index
+        output_gradient = np.copy(y_pred)
+        output_gradient[label_indices(y_true)] -= 1
+        output_gradient /= len(y_true)
         return output_gradient
+
+    @staticmethod
+    def sparse_softmax_cross_entropy_and_prime(y_true, y_pred):
+        indices = label_indices(y_true)
+        # the label's predictions are gathered once, for the loss and for the gradient
+        predictions = y_pred[indices]
+        E = -np.mean(np.log(predictions + safe_epsilon(y_pred)))
+        output_gradient = np.copy(y_pred)
+        output_gradient[indices] = predictions - 1
+        output_gradient /= len(y_true)
+        return E, output_gradient
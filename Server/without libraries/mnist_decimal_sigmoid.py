@@ -1,12 +1,15 @@
 import random
-import numpy as np
+import sys
+import os
 from keras.datasets import mnist
 from keras.utils import np_utils
 
 from layers import Dense, Convolutional, Flatten
 from activations import Sigmoid
 from losses import BinaryCrossEntropy as BCE
-from network import train, predict
+from network import train, evaluate
+from serialization import save, load
+from fusion import compile
 
 
 def preprocess_data(x, y, limit):
@@ -26,26 +29,31 @@ def preprocess_data(x, y, limit):
 x_train, y_train = preprocess_data(x_train, y_train, 3200)  # 50 goes for validation
 x_test, y_test = preprocess_data(x_test, y_test, 100)
 
-# neural network
-network = [
-    Convolutional((1, 28, 28), 3, 3, 5),
-    Sigmoid(),
-    Flatten((5, 26, 26)),
-    Dense(5 * 26 * 26, 100),
-    Sigmoid(),
-    Dense(100, 10),
-    Sigmoid(),
-]
-
-# train
-train(network, x_train, y_train, BCE.binary_cross_entropy, BCE.binary_cross_entropy_prime, val_split=50/3200, epochs=100, learning_rate=0.1)
+MODEL_PATH = 'mnist_decimal_sigmoid.npnet'
+
+# python mnist_decimal_sigmoid.py --load reuses the network saved by an earlier run instead of training a new one
+if '--load' in sys.argv[1:] and os.path.exists(MODEL_PATH):
+    network = load(MODEL_PATH)
+else:
+    # neural network, its layer + activation pairs are fused (see fusion.py)
+    network = compile([
+        Convolutional((1, 28, 28), 3, 3, 5),
+        Sigmoid(),
+        Flatten((5, 26, 26)),
+        Dense(5 * 26 * 26, 100),
+        Sigmoid(),
+        Dense(100, 10),
+        Sigmoid(),
+    ])
+
+    # train
+    train(network, x_train, y_train, BCE.binary_cross_entropy, BCE.binary_cross_entropy_prime, val_split=50/3200, epochs=100, learning_rate=0.1,
+          loss_and_prime=BCE.binary_cross_entropy_and_prime)
+    save(network, MODEL_PATH)
 
 # test
-success_counter = 0
-for x, y in zip(x_test, y_test):
-    output = predict(network, x)
-    print(f'pred: {np.argmax(output)}, true: {np.argmax(y)}')
-    success_counter += (np.argmax(output) == np.argmax(y))
-
-print(f'success rate: {round(success_counter / len(x_test) * 100, 2)}%')
-
+metrics = evaluate(network, x_test, y_test, loss=BCE.binary_cross_entropy)
+print(f'loss: {metrics["loss"]:.4f}')
+print(f'success rate: {round(metrics["accuracy"] * 100, 2)}%')
+print('confusion matrix (rows are the true digits, columns the predicted ones):')
+print(metrics['confusion_matrix'])
@@ -1,48 +1,200 @@
-def predict(network, input):
-    output = input
-    for layer in network:
-        output = layer.forward(output)
+import numpy as np
+from dtypes import network_dtype, check_dtype
+from optimizers import SGD
+from loaders import Loader
+
+
+def forward(network, inputs, train=True, profiler=None):
+    # inputs is a batch of samples, the first axis is the sample axis
+    # the inputs are cast to the network's dtype once, every layer must then keep it
+    # with train=False the layers run in inference mode: no backward bookkeeping and Dropout does nothing
+    # a profiler (see profiler.py) records every layer's time, allocations and output shape
+    dtype = network_dtype(network)
+    output = inputs.astype(dtype, copy=False)
+    for index, layer in enumerate(network):
+        if profiler is None:
+            output = layer.forward(output, train)
+        else:
+            output = profiler.call_layer(index, layer, 'forward', layer.forward, output, train)
+        check_dtype(layer, output, dtype)
     return output
 
 
-def train(network, x_train, y_train, loss, loss_prime, val_split=None, epochs=1000, learning_rate=0.01, verbose=True):
+def predict_batch(network, inputs, profiler=None):
+    # the last layer's output is a reused buffer, so the caller gets its own copy
+    return np.copy(forward(network, inputs, train=False, profiler=profiler))
+
+
+def predict(network, input, profiler=None):
+    # a single sample is predicted as a batch of one
+    return predict_batch(network, input[np.newaxis], profiler)[0]
+
+
+def backward(network, grad, learning_rate, profiler=None):
+    dtype = network_dtype(network)
+    for index in reversed(range(len(network))):
+        layer = network[index]
+        if profiler is None:
+            grad = layer.backward(grad, learning_rate)
+        else:
+            grad = profiler.call_layer(index, layer, 'backward', layer.backward, grad, learning_rate)
+        check_dtype(layer, grad, dtype)
+    return grad
+
+
+# Releases the inputs, outputs, masks and buffers the training passes left on every layer
+def free_caches(network):
+    for layer in network:
+        layer.free_caches()
+
+
+# Float targets are cast to the network's dtype, so the loss gradient doesn't upcast the backward pass
+def cast_targets(network, y):
+    if np.issubdtype(y.dtype, np.floating):
+        return y.astype(network_dtype(network), copy=False)
+    return y
+
+
+# The (x, y) batches of an epoch, streamed by a loaders.Loader or sliced out of in-memory arrays
+def batches(x, y, batch_size, dtype):
+    if isinstance(x, Loader):
+        return x.batches(batch_size, dtype)
+    return ((x[start: start + batch_size], y[start: start + batch_size]) for start in range(0, len(x), batch_size))
+
+
+# The class of every sample of a batch of targets or predictions: y is a vector of integer labels,
+# a batch of one hot (or probability) vectors, or a batch of single probabilities of a binary output
+def to_classes(y):
+    if y.ndim == 1:
+        return y.astype(np.intp, copy=False)
+    y = y.reshape(len(y), -1)
+    if y.shape[1] == 1:
+        return (y[:, 0] > 0.5).astype(np.intp)
+    return np.argmax(y, axis=1)
+
+
+# Runs the network in inference mode over x in batches (x can be a loaders.Loader, y is then ignored)
+# Returns the mean loss (when a loss is given), the accuracy and the confusion matrix,
+# whose rows are the true classes and whose columns are the predicted ones
+def evaluate(network, x, y, batch_size=64, loss=None, profiler=None):
+    dtype = network_dtype(network)
+    error = 0
+    samples_amount = 0
+    confusion_matrix = None
+    for x_batch, y_batch in batches(x, y, batch_size, dtype):
+        y_batch = cast_targets(network, y_batch)
+        y_hat = forward(network, x_batch, train=False, profiler=profiler)
+        if loss is not None:
+            error += loss(y_batch, y_hat) * len(x_batch)
+
+        # every (true, predicted) pair is counted at once, as an index into the flattened matrix
+        classes_amount = max(y_hat.shape[1], 2)
+        if confusion_matrix is None:
+            confusion_matrix = np.zeros((classes_amount, classes_amount), dtype=np.int64)
+        pairs = to_classes(y_batch) * classes_amount + to_classes(y_hat)
+        confusion_matrix += np.bincount(pairs, minlength=classes_amount ** 2).reshape(classes_amount, classes_amount)
+        samples_amount += len(x_batch)
+
+    return {
+        'loss': float(error / samples_amount) if loss is not None else None,
+        'accuracy': float(np.trace(confusion_matrix) / samples_amount),
+        'confusion_matrix': confusion_matrix,
+    }
+
+
+# The optimizer (plain SGD with learning_rate by default) applies one update per batch, see optimizers.py
+# With workers > 1 every batch is split across a pool of worker processes, see parallel.py
+# A profiler times every layer, the loss and the optimizer, and its report is printed at the end when verbose
+# loss_and_prime (e.g. losses.SparseSoftmaxCrossEntropy.sparse_softmax_cross_entropy_and_prime) computes the training
+# loss and gradient in one pass, loss alone is still used for the validation loss
+# The validation split is evaluated every validation_frequency epochs (and after the last one), in batches of
+# validation_batch_size since inference keeps no caches
+# x_train can be a loaders.Loader that streams the batches from disk, y_train is then ignored (the loader has the labels)
+def train(network, x_train, y_train, loss, loss_prime, val_split=None, epochs=1000, learning_rate=0.01, batch_size=1,
+          optimizer=None, workers=1, verbose=True, profiler=None, loss_and_prime=None, validation_frequency=1,
+          validation_batch_size=64):
+    if profiler is not None and workers > 1:
+        raise ValueError('The profiler only sees the master process, profile with workers=1')
+
+    streaming = isinstance(x_train, Loader)
+    if streaming and workers > 1:
+        raise ValueError('The worker processes slice in-memory arrays, train from a Loader with workers=1')
+
     validating = val_split and 0 < val_split < 1  # determines whether validation is performed
-    if validating:
+    if validating and streaming:
+        x_train, x_val = x_train.split(1 - val_split)
+        y_train = y_val = None
+    elif validating:
         train_size = int((1 - val_split) * len(x_train))
         x_val = x_train[train_size:]
         y_val = y_train[train_size:]
         x_train = x_train[0: train_size]
         y_train = y_train[0: train_size]
 
-    for epoch in range(epochs):
-        error = 0
-        for x, y in zip(x_train, y_train):
-            # forward
-            y_hat = predict(network, x)
+    if loss_and_prime is None:
+        def loss_and_prime(y_true, y_pred):
+            return loss(y_true, y_pred), loss_prime(y_true, y_pred)
 
-            # error
-            error += loss(y, y_hat)
+    if optimizer is None:
+        optimizer = SGD(learning_rate)
+    optimizer.attach(network)
 
-            # backward
-            grad = loss_prime(y, y_hat)
-            for layer in reversed(network):
-                grad = layer.backward(grad, learning_rate)
+    trainer = None
+    if workers > 1:
+        # imported here since parallel.py builds on this module
+        from parallel import ParallelTrainer
+        trainer = ParallelTrainer(network, optimizer, x_train, y_train, loss_and_prime, workers)
+
+    dtype = network_dtype(network)
+    completed = False
+    try:
+        for epoch in range(epochs):
+            error = 0
+            if trainer is not None:
+                for start in range(0, len(x_train), batch_size):
+                    error += trainer.compute_gradients(start, min(start + batch_size, len(x_train)))
+                    optimizer.step()
+            else:
+                for x, y in batches(x_train, y_train, batch_size, dtype):
+                    y = cast_targets(network, y)
 
-        # calculate validation loss for epoch
-        if validating:
-            val_error = 0
-            for x, y in zip(x_val, y_val):
-                # forward
-                y_hat = predict(network, x)
+                    # forward
+                    y_hat = forward(network, x, profiler=profiler)
 
-                # error
-                val_error += loss(y, y_hat)
+                    # error (the loss is averaged over the batch)
+                    # backward, the gradient is averaged over the batch so there's one update per batch
+                    if profiler is None:
+                        batch_error, grad = loss_and_prime(y, y_hat)
+                        backward(network, grad, None)
+                        optimizer.step()
+                    else:
+                        batch_error, grad = profiler.call('loss', 'both', loss_and_prime, y, y_hat)
+                        backward(network, grad, None, profiler)
+                        profiler.call('optimizer', 'step', optimizer.step)
+                    error += batch_error * len(x)
 
-            val_error /= len(x_val)
+            # calculate validation loss and accuracy for epoch
+            validated = validating and ((epoch + 1) % validation_frequency == 0 or epoch + 1 == epochs)
+            if validated:
+                validation = evaluate(network, x_val, y_val, validation_batch_size, loss, profiler)
 
-        error /= len(x_train)
+            error /= len(x_train)
+            if verbose:
+                if validated:
+                    print(f'Epoch {epoch + 1}/{epochs}, loss: {error:.4f} - val loss: {validation["loss"]:.4f}'
+                          f' - val accuracy: {validation["accuracy"]:.4f}')
+                else:
+                    print(f'Epoch {epoch + 1}/{epochs}, loss: {error:.4f}')
+        completed = True
+    finally:
+        if trainer is not None:
+            # after an error or an interrupt the workers may still be running a task, they're terminated instead
+            trainer.close(terminate=not completed)
+
+    # the training buffers aren't needed for inference, so they're released once training is done
+    free_caches(network)
+
+    if profiler is not None:
+        profiler.stop()
         if verbose:
-            if validating:
-                print(f'Epoch {epoch + 1}/{epochs}, loss: {error:.4f} - val loss: {val_error:.4f}')
-            else:
-                print(f'Epoch {epoch + 1}/{epochs}, loss: {error:.4f}')
+            print(profiler.report())
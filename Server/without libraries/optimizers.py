@@ -0,0 +1,133 @@
+import numpy as np
+from dtypes import network_dtype
+
+
+# Base Optimizer
+# attach packs every parameter and every gradient of a network into two flat arrays and hands the layers views into them,
+# so step updates all the layers at once with a few in-place operations over the whole flat array
+class Optimizer:
+    def __init__(self, learning_rate):
+        self.learning_rate = learning_rate
+        self.parameters = None
+        self.gradients = None
+
+    def attach(self, network):
+        dtype = network_dtype(network)
+        self.slots = [(layer, name) for layer in network for name in layer.parameter_names]
+        total_size = sum(getattr(layer, name).size for layer, name in self.slots)
+        self.gradients = np.zeros(total_size, dtype=dtype)
+        self.scratch = np.empty(total_size, dtype=dtype)  # holds intermediate results, so step doesn't allocate
+        self.bind_parameters(np.empty(total_size, dtype=dtype))
+
+        offset = 0
+        for layer, name in self.slots:
+            size = getattr(layer, name).size
+            layer.gradients = getattr(layer, 'gradients', {})
+            layer.gradients[name] = self.gradients[offset: offset + size].reshape(getattr(layer, name).shape)
+            offset += size
+
+        self.initialize()
+
+    # Copies the parameters into the given flat buffer (e.g. one in shared memory) and makes the layers use views into it
+    def bind_parameters(self, buffer):
+        offset = 0
+        for layer, name in self.slots:
+            parameter = getattr(layer, name)
+            parameter_view = buffer[offset: offset + parameter.size].reshape(parameter.shape)
+            parameter_view[...] = parameter
+            setattr(layer, name, parameter_view)
+            offset += parameter.size
+        self.parameters = buffer
+
+    def initialize(self):
+        # allocates the optimizer's state, once the flat arrays exist
+        pass
+
+    def step(self):
+        # updates the parameters using the gradients of the last backward pass
+        pass
+
+
+# Stochastic Gradient Descent, with optional (heavy ball) momentum
+class SGD(Optimizer):
+    def __init__(self, learning_rate=0.01, momentum=0.0):
+        super().__init__(learning_rate)
+        self.momentum = momentum
+
+    def initialize(self):
+        self.velocity = np.zeros_like(self.parameters)
+
+    def step(self):
+        # g = learning rate * dE/dP
+        np.multiply(self.gradients, self.learning_rate, out=self.scratch)
+        if self.momentum:
+            # V = momentum * V - g, P = P + V
+            self.velocity *= self.momentum
+            self.velocity -= self.scratch
+            self.parameters += self.velocity
+        else:
+            # P = P - g
+            self.parameters -= self.scratch
+
+
+# Root Mean Square Propagation, scales every parameter's step by a moving average of its squared gradients
+class RMSProp(Optimizer):
+    def __init__(self, learning_rate=0.001, rho=0.9, epsilon=1e-7):
+        super().__init__(learning_rate)
+        self.rho = rho
+        self.epsilon = epsilon
+
+    def initialize(self):
+        self.squares_average = np.zeros_like(self.parameters)
+
+    def step(self):
+        # S = rho * S + (1 - rho) * (dE/dP)^2
+        np.square(self.gradients, out=self.scratch)
+        self.scratch *= 1 - self.rho
+        self.squares_average *= self.rho
+        self.squares_average += self.scratch
+
+        # P = P - learning rate * dE/dP / (√S + epsilon)
+        np.sqrt(self.squares_average, out=self.scratch)
+        self.scratch += self.epsilon
+        np.divide(self.gradients, self.scratch, out=self.scratch)
+        self.scratch *= self.learning_rate
+        self.parameters -= self.scratch
+
+
+# Adaptive Moment Estimation, the optimizer create_model.py trains the Keras model with
+class Adam(Optimizer):
+    def __init__(self, learning_rate=0.001, beta_1=0.9, beta_2=0.999, epsilon=1e-7):
+        super().__init__(learning_rate)
+        self.beta_1 = beta_1
+        self.beta_2 = beta_2
+        self.epsilon = epsilon
+
+    def initialize(self):
+        self.first_moment = np.zeros_like(self.parameters)
+        self.second_moment = np.zeros_like(self.parameters)
+        self.steps = 0
+
+    def step(self):
+        self.steps += 1
+
+        # M = beta 1 * M + (1 - beta 1) * dE/dP
+        self.first_moment *= self.beta_1
+        np.multiply(self.gradients, 1 - self.beta_1, out=self.scratch)
+        self.first_moment += self.scratch
+
+        # V = beta 2 * V + (1 - beta 2) * (dE/dP)^2
+        self.second_moment *= self.beta_2
+        np.square(self.gradients, out=self.scratch)
+        self.scratch *= 1 - self.beta_2
+        self.second_moment += self.scratch
+
+        # the bias correction of both moments is folded into the step size
+        step_size = self.learning_rate * np.sqrt(1 - self.beta_2 ** self.steps) / (1 - self.beta_1 ** self.steps)
+
+        # P = P - step size * M / (√V + epsilon)
+        np.sqrt(self.second_moment, out=self.scratch)
+        self.scratch += self.epsilon
+        np.divide(self.first_moment, self.scratch, out=self.scratch)
+        self.scratch *= float(step_size)
+        self.parameters -= self.scratch
@@ -0,0 +1,107 @@
+import numpy as np
+from multiprocessing import get_context, shared_memory
+from network import forward, backward, cast_targets
+
+
+# Data parallel training: every batch is split into one contiguous shard per worker process
+# The parameters live in shared memory, so the optimizer's in-place step is seen by all the workers at once,
+# and every shard's gradients are written into its own row of a shared gradients array that the master sums
+# The pool is forked (Linux/macOS only), so the network and the training data are inherited instead of pickled
+# Set OMP_NUM_THREADS=1 (or the BLAS library's equivalent) so the workers don't fight over cores
+
+
+# The state of a worker process, set once by initialize_worker
+worker_state = {}
+
+
+def initialize_worker(network, x_train, y_train, loss_and_prime, gradient_views, seeds):
+    worker_state.update(network=network, x_train=x_train, y_train=y_train, loss_and_prime=loss_and_prime,
+                        gradient_views=gradient_views, seeds=seeds)
+
+
+def compute_shard_gradients(task):
+    slot, start, stop, batch_size, step = task
+    network = worker_state['network']
+
+    # every forked worker starts with the master's random state, so the Dropout layers get a generator of the shard's
+    # own, derived from the master's seed and the (step, slot) of the shard rather than from the worker, since which
+    # worker gets which shard changes from run to run
+    for index, seed in worker_state['seeds'].items():
+        network[index].generator = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(step, slot)))
+
+    # the shard's gradients are written into the shard's row of the shared gradients array
+    for layer, name, gradient_view in worker_state['gradient_views'][slot]:
+        layer.gradients[name] = gradient_view
+
+    x = worker_state['x_train'][start: stop]
+    y = cast_targets(network, worker_state['y_train'][start: stop])
+    y_hat = forward(network, x)
+
+    # the loss prime is averaged over the shard, weighting it by the shard's share of the batch
+    # makes the sum of all the rows the average over the whole batch
+    error, grad = worker_state['loss_and_prime'](y, y_hat)
+    grad *= (stop - start) / batch_size
+    backward(network, grad, None)
+
+    return error * (stop - start)
+
+
+class ParallelTrainer:
+    def __init__(self, network, optimizer, x_train, y_train, loss_and_prime, workers):
+        self.optimizer = optimizer
+        self.workers = workers
+        parameters = optimizer.parameters
+
+        # move the parameters into shared memory, the layers are rebound to views of it
+        self.parameters_memory = shared_memory.SharedMemory(create=True, size=parameters.nbytes)
+        self.gradients_memory = shared_memory.SharedMemory(create=True, size=parameters.nbytes * workers)
+        optimizer.bind_parameters(np.ndarray(parameters.shape, dtype=parameters.dtype, buffer=self.parameters_memory.buf))
+        self.gradient_rows = np.ndarray((workers, parameters.size), dtype=parameters.dtype, buffer=self.gradients_memory.buf)
+
+        # for every slot, the views into its gradients row that replace the layers' gradient arrays
+        gradient_views = []
+        for gradient_row in self.gradient_rows:
+            views = []
+            offset = 0
+            for layer, name in optimizer.slots:
+                parameter = getattr(layer, name)
+                views.append((layer, name, gradient_row[offset: offset + parameter.size].reshape(parameter.shape)))
+                offset += parameter.size
+            gradient_views.append(views)
+
+        # the Dropout layers' seeds are drawn from their master generators, so np.random.seed repeats parallel runs too
+        seeds = {index: int(layer.generator.integers(2 ** 63)) for index, layer in enumerate(network)
+                 if hasattr(layer, 'generator')}
+        self.step = 0  # the number of batches computed so far
+
+        self.pool = get_context('fork').Pool(workers, initialize_worker,
+                                             (network, x_train, y_train, loss_and_prime, gradient_views, seeds))
+
+    # Computes the batch average gradients of x_train[start: stop] into the optimizer's gradients
+    # Returns the sum of the samples' losses
+    def compute_gradients(self, start, stop):
+        bounds = np.linspace(start, stop, self.workers + 1).astype(int)
+        shards = [(int(shard_start), int(shard_stop)) for shard_start, shard_stop in zip(bounds[: -1], bounds[1:])
+                  if shard_start < shard_stop]
+        tasks = [(slot, shard_start, shard_stop, stop - start, self.step)
+                 for slot, (shard_start, shard_stop) in enumerate(shards)]
+        self.step += 1
+
+        errors = self.pool.map(compute_shard_gradients, tasks)
+        np.sum(self.gradient_rows[: len(tasks)], axis=0, out=self.optimizer.gradients)
+        return sum(errors)
+
+    def close(self, terminate=False):
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+        del self.pool
+
+        # the parameters are moved back into private memory before the shared blocks are released
+        self.optimizer.bind_parameters(np.empty_like(self.optimizer.parameters))
+        del self.gradient_rows
+        for memory in (self.parameters_memory, self.gradients_memory):
+            memory.close()
+            memory.unlink()
@@ -0,0 +1,87 @@
+import tracemalloc
+import json
+import time
+
+
+# Opt-in per layer instrumentation: pass a Profiler as profiler= to forward, backward, predict or train
+# Without one the network runs its plain loops, so a disabled profiler costs a single `is None` check per layer
+# Every call records its wall time and its output's shape, and with trace_memory=True also the bytes it allocated
+# (the peak traced memory above what was allocated before the call), which is slow but shows which layers
+# allocate instead of reusing their buffers
+class Profiler:
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.started_tracing = False
+        self.records = {}  # (name, phase) -> the calls, seconds, allocated bytes and output shapes of the calls
+
+    # Calls function(*args) and records it under the given name and phase ('forward', 'backward', 'step' ...)
+    def call(self, name, phase, function, *args):
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            tracemalloc.reset_peak()
+            allocated_before = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+
+        record = self.records.get((name, phase))
+        if record is None:
+            record = self.records[(name, phase)] = {'calls': 0, 'seconds': 0.0, 'allocated_bytes': 0, 'shapes': []}
+        record['calls'] += 1
+        record['seconds'] += seconds
+        if self.trace_memory:
+            record['allocated_bytes'] += tracemalloc.get_traced_memory()[1] - allocated_before
+        shape = getattr(result, 'shape', None)
+        if shape is not None and shape not in record['shapes']:
+            record['shapes'].append(shape)
+
+        return result
+
+    # Calls one of the network's layers, named after its position and class
+    def call_layer(self, index, layer, phase, function, *args):
+        return self.call(f'{index} {type(layer).__name__}', phase, function, *args)
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def reset(self):
+        self.records = {}
+
+    def to_dict(self):
+        total_seconds = sum(record['seconds'] for record in self.records.values())
+        return [{'name': name, 'phase': phase, 'calls': record['calls'], 'seconds': record['seconds'],
+                 'mean_seconds': record['seconds'] / record['calls'],
+                 'share': record['seconds'] / total_seconds if total_seconds else 0.0,
+                 'allocated_bytes': record['allocated_bytes'] if self.trace_memory else None,
+                 'output_shapes': [list(shape) for shape in record['shapes']]}
+                for (name, phase), record in self.records.items()]
+
+    def save_json(self, path):
+        with open(path, 'w') as json_file:
+            json.dump(self.to_dict(), json_file, indent=2)
+
+    # A table of every (name, phase), slowest first
+    def report(self):
+        rows = sorted(self.to_dict(), key=lambda row: row['seconds'], reverse=True)
+        name_width = max([24] + [len(row['name']) + 2 for row in rows])
+        lines = [f'{"layer":<{name_width}}{"phase":<10}{"calls":>8}{"total ms":>12}{"mean ms":>10}{"share":>8}'
+                 f'{"allocated":>12}  output shapes']
+        for row in rows:
+            allocated = '-' if row['allocated_bytes'] is None else format_bytes(row['allocated_bytes'])
+            shapes = ', '.join(str(tuple(shape)) for shape in row['output_shapes'])
+            lines.append(f'{row["name"]:<{name_width}}{row["phase"]:<10}{row["calls"]:>8}{row["seconds"] * 1000:>12.2f}'
+                         f'{row["mean_seconds"] * 1000:>10.3f}{row["share"]:>8.1%}{allocated:>12}  {shapes}')
+        return '\n'.join(lines)
+
+
+def format_bytes(amount):
+    for unit in ('B', 'KB', 'MB'):
+        if abs(amount) < 1024:
+            return f'{amount:.0f} {unit}' if unit == 'B' else f'{amount:.1f} {unit}'
+        amount /= 1024
+    return f'{amount:.1f} GB'
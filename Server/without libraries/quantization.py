@@ -0,0 +1,179 @@
+import numpy as np
+from layers import Convolutional, Dense
+from convolution import im2col
+from network import batches, network_dtype
+from fusion import FUSABLE_ACTIVATIONS
+
+
+# Post training int8 quantization for inference
+# The weights of every Dense and Convolutional layer are stored as int8 with one float32 scale per output channel
+# (W ≈ W_q * s_w[c]), which is 8 times smaller than float64 and 4 times smaller than float32 weights
+# The layers' inputs are quantized with a per tensor scale calibrated on sample inputs (X ≈ X_q * s_x), the int8
+# products are accumulated as int32 and requantized to float32 with s_x * s_w[c], so the activations between the
+# quantized layers run in float32 and the next quantized layer quantizes its input again with its own scale
+# The layers are inference only, train on the float network and quantize it afterwards
+
+QUANTIZED_MAX = 127  # symmetric int8, -128 is left out so 0 is exactly representable and the range is symmetric
+
+# BLAS has no integer GEMM, so the int8 products run in float32 over blocks of the summed axis short enough that
+# every partial sum is an integer below 2^24, which float32 represents exactly, and the blocks are summed as int32
+ACCUMULATION_BLOCK = 2 ** 24 // QUANTIZED_MAX ** 2
+
+
+# Symmetric int8 scales along the first axis of weights, one per output channel
+def channel_scales(weights):
+    max_values = np.max(np.abs(weights.reshape(len(weights), -1)), axis=1)
+    # an all zero channel gets a scale of 1, its weights are 0 either way
+    return np.where(max_values > 0, max_values / QUANTIZED_MAX, 1).astype(np.float32)
+
+
+# Rounds values / scale to the nearest int8 value, into out (a float32 array that then holds integers)
+def quantize(values, scale, out):
+    np.multiply(values, 1 / scale, out=out, casting='unsafe')
+    np.rint(out, out=out)
+    np.clip(out, -QUANTIZED_MAX, QUANTIZED_MAX, out=out)
+    return out
+
+
+# left (M, K) · right (K, N) of int8 valued arrays, accumulated exactly as int32 and written into the float32 array out
+# buffer is the calling layer's Workspace.buffer, for the int32 accumulator
+def integer_dot(left, right, out, buffer):
+    # only a block of an int8 operand is ever converted to float32, the int8 weights stay int8 in memory
+    if left.shape[1] <= ACCUMULATION_BLOCK:
+        # a single block is exact in float32 already
+        return np.dot(left.astype(np.float32, copy=False), right.astype(np.float32, copy=False), out=out)
+
+    accumulator = buffer('accumulator', out.shape, np.int32)
+    accumulator.fill(0)
+    for start in range(0, left.shape[1], ACCUMULATION_BLOCK):
+        stop = start + ACCUMULATION_BLOCK
+        partial = np.dot(left[:, start: stop].astype(np.float32, copy=False),
+                         right[start: stop].astype(np.float32, copy=False))
+        np.add(accumulator, partial, out=accumulator, casting='unsafe')
+    np.copyto(out, accumulator)
+    return out
+
+
+# int8 Dense Layer
+class QuantizedDense(Dense):
+    parameter_names = ('weights', 'weight_scales', 'input_scale', 'bias')
+
+    def __init__(self, input_size, output_size, initialize=True):
+        self.dtype = np.dtype(np.float32)
+        self.weights = np.zeros((output_size, input_size), dtype=np.int8)
+        self.weight_scales = np.ones((output_size, 1), dtype=np.float32)
+        self.input_scale = np.ones(1, dtype=np.float32)
+        self.bias = np.zeros((output_size, 1), dtype=np.float32)
+
+    def forward(self, input, train=True):
+        batch_size = len(input)
+        quantized_input = quantize(input[..., 0], self.input_scale[0],
+                                   self.buffer('quantized_input', (batch_size, self.weights.shape[1]), np.float32))
+        # Y_q = X_q · transposed(W_q), in int32
+        product = integer_dot(quantized_input, self.weights.T,
+                              self.buffer('product', (batch_size, len(self.weights)), np.float32), self.buffer)
+
+        # Y = Y_q * s_x * s_w + B
+        output = self.buffer('output', (batch_size, len(self.weights), 1), self.dtype)
+        np.multiply(product[..., np.newaxis], self.weight_scales * self.input_scale[0], out=output)
+        output += self.bias
+        return output
+
+    def backward(self, output_gradient, learning_rate):
+        raise NotImplementedError('Quantized layers are inference only')
+
+
+# int8 Convolutional Layer
+class QuantizedConvolutional(Convolutional):
+    parameter_names = ('filters', 'filter_scales', 'input_scale', 'biases')
+
+    def __init__(self, input_shape, kernel_height, kernel_width, filters_amount, backend='im2col', initialize=True,
+                 stride=1, padding='valid'):
+        super().__init__(input_shape, kernel_height, kernel_width, filters_amount, backend, False, stride, padding)
+        self.dtype = np.dtype(np.float32)
+        self.filters = np.zeros(self.filters_shape, dtype=np.int8)
+        self.filter_scales = np.ones((filters_amount, 1, 1), dtype=np.float32)
+        self.input_scale = np.ones(1, dtype=np.float32)
+        self.biases = np.zeros(self.output_shape, dtype=np.float32)
+
+    def forward(self, input, train=True):
+        # 0 quantizes to 0, so the input can be padded before or after it's quantized
+        batch_size = len(input)
+        quantized_input = quantize(input, self.input_scale[0],
+                                   self.buffer('quantized_input', input.shape, np.float32))
+        quantized_input = self.pad(quantized_input)
+
+        kernel_height, kernel_width = self.filters_shape[2:]
+        output_height, output_width = self.output_shape[1:]
+        columns = self.buffer('columns', (np.prod(self.filters_shape[1:]), batch_size * output_height * output_width), np.float32)
+        im2col(quantized_input, kernel_height, kernel_width, self.stride, out=columns)
+
+        # Y_q = F_q · cols_q, in int32
+        product = integer_dot(self.filters.reshape(self.filters_amount, -1), columns,
+                              self.buffer('product', (self.filters_amount, len(columns[0])), np.float32), self.buffer)
+
+        # Y = Y_q * s_x * s_f + B
+        output = self.buffer('output', (batch_size, *self.output_shape), self.dtype)
+        np.multiply(product.reshape(self.filters_amount, batch_size, output_height, output_width).transpose(1, 0, 2, 3),
+                    self.filter_scales * self.input_scale[0], out=output)
+        output += self.biases
+        return output
+
+    def backward(self, output_gradient, learning_rate):
+        raise NotImplementedError('Quantized layers are inference only')
+
+
+# The input scale of every Dense and Convolutional layer (by index), from running the float network on inputs
+# The scale covers the largest input value, or with percentile < 100 the batches' average percentile of the absolute
+# input values, which clips rare outliers and spends the int8 range on the common values
+def calibrate(network, inputs, batch_size=64, percentile=100.0):
+    dtype = network_dtype(network)
+    ranges = {index: [] for index, layer in enumerate(network) if isinstance(layer, (Dense, Convolutional))}
+    for x, _ in batches(inputs, inputs, batch_size, dtype):
+        output = x.astype(dtype, copy=False)
+        for index, layer in enumerate(network):
+            if index in ranges:
+                magnitudes = np.abs(output)
+                ranges[index].append(np.max(magnitudes) if percentile >= 100 else np.percentile(magnitudes, percentile))
+            output = layer.forward(output, train=False)
+
+    scales = {}
+    for index, values in ranges.items():
+        value = max(values) if percentile >= 100 else np.mean(values)
+        scales[index] = np.float32(value / QUANTIZED_MAX if value > 0 else 1)
+    return scales
+
+
+# Returns an int8 copy of a trained network, the other layers are rebuilt from their configs
+# The activation of a fused layer (see fusion.py) becomes a separate layer again, after the requantization
+def quantize_network(network, calibration_inputs, batch_size=64, percentile=100.0):
+    scales = calibrate(network, calibration_inputs, batch_size, percentile)
+    quantized_network = []
+    for index, layer in enumerate(network):
+        config = layer.get_config()
+        activation = config.pop('activation', None) if isinstance(layer, (Convolutional, Dense)) else None
+        if isinstance(layer, Convolutional):
+            quantized_layer = QuantizedConvolutional(**config)
+            quantized_layer.filter_scales[...] = channel_scales(layer.filters).reshape(-1, 1, 1)
+            quantized_layer.filters[...] = quantize(layer.filters, quantized_layer.filter_scales[..., np.newaxis],
+                                                    np.empty(layer.filters.shape, dtype=np.float32))
+            quantized_layer.biases[...] = layer.biases
+        elif isinstance(layer, Dense):
+            quantized_layer = QuantizedDense(**config)
+            quantized_layer.weight_scales[...] = channel_scales(layer.weights)[:, np.newaxis]
+            quantized_layer.weights[...] = quantize(layer.weights, quantized_layer.weight_scales,
+                                                    np.empty(layer.weights.shape, dtype=np.float32))
+            quantized_layer.bias[...] = layer.bias
+        else:
+            quantized_network.append(type(layer)(**config))
+            continue
+        quantized_layer.input_scale[0] = scales[index]
+        quantized_network.append(quantized_layer)
+        if activation is not None:
+            quantized_network.append(FUSABLE_ACTIVATIONS[activation]())
+    return quantized_network
+
+
+# The bytes of every layer's parameters
+def parameters_size(network):
+    return sum(getattr(layer, name).nbytes for layer in network for name in layer.parameter_names)
@@ -0,0 +1,103 @@
+import numpy as np
+import time
+import sys
+import os
+from network import evaluate, predict_batch
+from quantization import quantize_network, parameters_size
+from serialization import load
+
+
+# Accuracy vs speed of the int8 quantized networks against their float originals, on:
+#   the models saved by the mnist_*.py scripts, on the MNIST test set
+#   models/top_model.npnet (see keras_import.py), on the Server/Test CAPTCHA tiles
+# The models that don't exist yet are skipped
+# Usage: python quantization_report.py [calibration samples] [test samples]
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIRECTORY = os.path.dirname(DIRECTORY)
+MNIST_MODELS = ['mnist_binary.npnet', 'mnist_decimal_sigmoid.npnet', 'mnist_decimal_softmax.npnet']
+CAPTCHA_MODEL = os.path.join(SERVER_DIRECTORY, 'models', 'top_model.npnet')
+BATCH_SIZE = 64
+
+
+def load_mnist(model_name, samples_amount):
+    from keras.datasets import mnist  # only the MNIST part of the report needs Keras
+
+    (x_train, y_train), (x_test, y_test) = mnist.load_data()
+    if model_name == 'mnist_binary.npnet':
+        # the binary model only tells zeros and ones apart
+        x_train, y_train = x_train[y_train < 2], y_train[y_train < 2]
+        x_test, y_test = x_test[y_test < 2], y_test[y_test < 2]
+    x_train = x_train.reshape(len(x_train), 1, 28, 28) / 255
+    x_test = x_test.reshape(len(x_test), 1, 28, 28) / 255
+    return x_train, x_test[: samples_amount], y_test[: samples_amount]
+
+
+def load_captcha_tiles():
+    sys.path.append(SERVER_DIRECTORY)
+    from dataset_store import load_dataset  # the Server's packed dataset store
+
+    # the classes are numbered in the order captcha_solver lists them
+    tiles, labels, _ = load_dataset(os.path.join(SERVER_DIRECTORY, 'Test'),
+                                    os.listdir(os.path.join(SERVER_DIRECTORY, 'Dataset')))
+    order = np.random.default_rng(0).permutation(len(tiles))
+    return tiles[order].transpose(0, 3, 1, 2) / 255, labels[order]
+
+
+# The best time of predicting x in batches
+def measure(network, x, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for batch_start in range(0, len(x), BATCH_SIZE):
+            predict_batch(network, x[batch_start: batch_start + BATCH_SIZE])
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(name, network, calibration_inputs, x_test, y_test):
+    quantized_network = quantize_network(network, calibration_inputs, BATCH_SIZE)
+    float_metrics = evaluate(network, x_test, y_test, BATCH_SIZE)
+    quantized_metrics = evaluate(quantized_network, x_test, y_test, BATCH_SIZE)
+
+    agreement = np.mean(np.argmax(predict_batch(network, x_test), axis=1) ==
+                        np.argmax(predict_batch(quantized_network, x_test), axis=1))
+    float_time, quantized_time = measure(network, x_test), measure(quantized_network, x_test)
+    float_size, quantized_size = parameters_size(network), parameters_size(quantized_network)
+    # the size the same network's parameters would take in float64
+    float64_size = sum(getattr(layer, name).size * 8 for layer in network for name in layer.parameter_names)
+
+    print(f'{name} ({len(x_test)} samples)')
+    print(f'    accuracy: float {float_metrics["accuracy"]:.2%}, int8 {quantized_metrics["accuracy"]:.2%},'
+          f' predictions agree {agreement:.2%}')
+    print(f'    time: float {float_time * 1000:.1f} ms, int8 {quantized_time * 1000:.1f} ms'
+          f' ({float_time / quantized_time:.2f}x)')
+    print(f'    parameters: float {float_size / 1024:.1f} KB, int8 {quantized_size / 1024:.1f} KB'
+          f' ({float_size / quantized_size:.1f}x smaller, {float64_size / quantized_size:.1f}x smaller than float64)')
+
+
+def main():
+    calibration_amount = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    test_amount = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    for model_name in MNIST_MODELS:
+        model_path = os.path.join(DIRECTORY, model_name)
+        if not os.path.exists(model_path):
+            print(f'{model_name} not found, run {model_name[: -len(".npnet")]}.py first')
+            continue
+        x_train, x_test, y_test = load_mnist(model_name, test_amount)
+        report(model_name, load(model_path), x_train[: calibration_amount], x_test, y_test)
+
+    if not os.path.exists(CAPTCHA_MODEL):
+        print(f'{CAPTCHA_MODEL} not found, convert models/top_model.h5 with keras_import.py first')
+        return
+    # the tiles the network is calibrated on are left out of the tested ones
+    tiles, labels = load_captcha_tiles()
+    calibration_amount = min(calibration_amount, len(tiles) // 2)
+    test_end = calibration_amount + test_amount
+    report('top_model.npnet', load(CAPTCHA_MODEL), tiles[: calibration_amount],
+           tiles[calibration_amount: test_end], labels[calibration_amount: test_end])
+
+
+if __name__ == '__main__':
+    main()
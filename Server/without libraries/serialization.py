@@ -0,0 +1,100 @@
+import numpy as np
+import struct
+import json
+import layers
+import activations
+import quantization
+import fusion
+
+
+# Native model file format:
+#   magic (8 bytes) | format version (uint32) | header length (uint64) | JSON header | padding | weights blob
+# The header holds the architecture (every layer's class and constructor arguments) and the dtype, shape and blob offset
+# of every parameter. The blob is aligned to ALIGNMENT bytes and so is every parameter inside it, which lets load
+# memory-map the weights instead of reading them: startup doesn't depend on the network's size, and processes
+# that load the same file share one physical copy of the weights through the page cache
+MAGIC = b'NPNETWRK'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+PREAMBLE = struct.Struct('<8sIQ')
+
+LAYER_CLASSES = {layer_class.__name__: layer_class for layer_class in [
+    layers.Convolutional, layers.Dense, layers.Dropout, layers.Flatten, layers.Reshape, layers.MaxPooling,
+    activations.Tanh, activations.Sigmoid, activations.ReLU, activations.Softmax, activations.FusedSoftmax,
+    quantization.QuantizedDense, quantization.QuantizedConvolutional, fusion.FusedDense, fusion.FusedConvolutional,
+]}
+
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save(network, path):
+    header = {'version': FORMAT_VERSION, 'layers': []}
+    parameters = []
+    offset = 0
+    for layer in network:
+        layer_header = {'class': type(layer).__name__, 'config': layer.get_config(), 'parameters': []}
+        for name in layer.parameter_names:
+            parameter = np.ascontiguousarray(getattr(layer, name))
+            layer_header['parameters'].append({'name': name, 'dtype': parameter.dtype.str, 'shape': parameter.shape,
+                                               'offset': offset})
+            parameters.append((offset, parameter))
+            offset = align(offset + parameter.nbytes)
+        header['layers'].append(layer_header)
+
+    encoded_header = json.dumps(header).encode('utf-8')
+    blob_start = align(PREAMBLE.size + len(encoded_header))
+
+    with open(path, 'wb') as model_file:
+        model_file.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(encoded_header)))
+        model_file.write(encoded_header)
+        for parameter_offset, parameter in parameters:
+            model_file.seek(blob_start + parameter_offset)
+            model_file.write(parameter.tobytes())
+        # make sure the file reaches the end of the blob, even if the last parameter is empty
+        model_file.truncate(blob_start + offset)
+
+
+# mmap_mode is passed to np.memmap: 'r' (read only, shared between processes), 'c' (copy on write) or 'r+'
+# None reads the weights into private memory instead
+def load(path, mmap_mode='r'):
+    with open(path, 'rb') as model_file:
+        magic, version, header_length = PREAMBLE.unpack(model_file.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a model file')
+        if version > FORMAT_VERSION:
+            raise ValueError(f'{path} has format version {version}, only versions up to {FORMAT_VERSION} are supported')
+        header = json.loads(model_file.read(header_length).decode('utf-8'))
+
+    blob_start = align(PREAMBLE.size + header_length)
+    blob = None
+    if mmap_mode is not None and any(layer_header['parameters'] for layer_header in header['layers']):
+        blob = np.memmap(path, dtype=np.uint8, mode=mmap_mode, offset=blob_start)
+
+    network = []
+    for layer_header in header['layers']:
+        layer_class = LAYER_CLASSES[layer_header['class']]
+        # JSON turns the shape tuples into lists
+        config = {key: tuple(value) if isinstance(value, list) else value for key, value in layer_header['config'].items()}
+        if layer_class.parameter_names:
+            config['initialize'] = False
+        layer = layer_class(**config)
+
+        for parameter_header in layer_header['parameters']:
+            dtype, shape = np.dtype(parameter_header['dtype']), tuple(parameter_header['shape'])
+            size = dtype.itemsize * int(np.prod(shape))
+            if blob is not None:
+                start = parameter_header['offset']
+                parameter = blob[start: start + size].view(dtype).reshape(shape)
+            else:
+                parameter = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)),
+                                        offset=blob_start + parameter_header['offset']).reshape(shape)
+            setattr(layer, parameter_header['name'], parameter)
+            # a layer runs in the dtype of its float parameters (a quantized layer's int8 weights don't count)
+            if np.issubdtype(dtype, np.floating):
+                layer.dtype = dtype
+
+        network.append(layer)
+
+    return network
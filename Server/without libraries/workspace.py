@@ -0,0 +1,19 @@
+import numpy as np
+
+
+# Keeps the arrays a layer (or a convolution backend) writes its results into, so training steps don't allocate
+# A buffer is planned once per (name, dtype) and starts zeroed, every later request of the same shape gets the same
+# array back and a request of another shape (e.g. another batch size) replaces it, so a layer only ever holds one
+# set of buffers
+class Workspace:
+    def buffer(self, name, shape, dtype):
+        buffers = self.__dict__.setdefault('buffers', {})
+        key = (name, np.dtype(dtype))
+        shape = tuple(shape)
+        buffer = buffers.get(key)
+        if buffer is None or buffer.shape != shape:
+            buffer = buffers[key] = np.zeros(shape, dtype=dtype)
+        return buffer
+
+    def free_buffers(self):
+        self.__dict__.pop('buffers', None)